@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+#
+# MIT License
+#
+# (C) Copyright [2021] Hewlett Packard Enterprise Development LP
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# Benchmark of backport command. Generates synthetic repository, serves GitHub API with local stub
+# and runs backport_command.py as the action would, collecting its metrics over several runs.
+#
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from backport_command import cmd
+from backport_stub_api import StubGitHubApi
+
+REPOSITORY = "benchmark/repo"
+
+def write_file(path, size, rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("".join(rng.choice("abcdefghijklmnopqrstuvwxyz\n") for i in range(size)))
+
+def commit_change(path, message):
+    with open(path, "a") as f:
+        f.write("%s\n" % message)
+    cmd("git commit -q -a -m '%s'" % message)
+
+def generate_repo(workdir, options):
+    # Creates bare repository origin.git with main branch, release branches and PR #1 head in refs/pull/1/head.
+    # Histories of main and release branches change files in dir000, PR commits change files in other
+    # directories, so that PR applies cleanly to every release branch. Returns clone URL.
+    rng = random.Random(options.seed)
+    origin = os.path.join(workdir, "origin.git")
+    work = os.path.join(workdir, "work")
+    cmd("git init -q --bare --initial-branch=main %s" % origin)
+    cmd("git -C %s config uploadpack.allowFilter true" % origin)
+    cmd("git init -q --initial-branch=main %s" % work)
+    os.chdir(work)
+    files = list(map(lambda x: "dir%03d/file%05d.txt" % (x % options.dirs, x), range(options.files)))
+    for path in files:
+        write_file(path, options.file_size, rng)
+    cmd("git add -A && git commit -q -m 'Initial commit'")
+    history_files = list(filter(lambda x: x.startswith("dir000/"), files))
+    pr_files = list(filter(lambda x: not x.startswith("dir000/"), files)) or files
+    branches = list(map(lambda x: "release/%d" % (x + 1), range(options.branches)))
+    for branch in branches:
+        cmd("git checkout -q -b %s main" % branch)
+        for i in range(options.history):
+            commit_change(rng.choice(history_files), "Change %d of %s" % (i, branch))
+    cmd("git checkout -q main")
+    for i in range(options.history):
+        commit_change(rng.choice(history_files), "Change %d of main" % i)
+    cmd("git checkout -q -b feature")
+    for i in range(options.commits):
+        commit_change(rng.choice(pr_files), "PR change %d" % i)
+    cmd("git push -q %s main %s feature:refs/pull/1/head" % (origin, " ".join(branches)))
+    os.chdir(workdir)
+    shutil.rmtree(work)
+    return "file://%s" % origin, branches
+
+def setup_stub(url):
+    # Stub GitHub API serving PR #1 with its commits, paginated by 100 like GitHub does
+    stub = StubGitHubApi()
+    commits = cmd("git -C %s rev-list --reverse refs/pull/1/head ^main" % url[len("file://"):])[0].split()
+    stub.add("GET", "/repos/%s/pulls/1" % REPOSITORY, 200, {
+        "number": 1,
+        "title": "Benchmark PR",
+        "_links": {"html": {"href": "https://github.com/%s/pull/1" % REPOSITORY}}
+    })
+    path = "/repos/%s/pulls/1/commits?per_page=100" % REPOSITORY
+    for page in range(max(1, (len(commits) + 99) // 100)):
+        headers = {}
+        if (page + 1) * 100 < len(commits):
+            headers["Link"] = "<%s%s&page=%d>; rel=\"next\"" % (stub.url, path, page + 2)
+        stub.add("GET", path + ("&page=%d" % (page + 1) if page > 0 else ""), 200,
+            list(map(lambda x: {"sha": x}, commits[page * 100:(page + 1) * 100])), headers)
+    stub.add("POST", "/repos/%s/pulls" % REPOSITORY, 201, {"number": 2, "html_url": "https://github.com/%s/pull/2" % REPOSITORY})
+    stub.add("POST", "/repos/%s/issues/1/comments" % REPOSITORY, 201, {"id": 1})
+    stub.add("PATCH", "/repos/%s/issues/comments/1" % REPOSITORY, 200, {"id": 1})
+    return stub
+
+def run_backport(workdir, url, branches, stub, options, run):
+    # Runs backport_command.py in separate process, the way the action runs it. Returns result of the run.
+    run_dir = os.path.join(workdir, "run%d" % run)
+    os.makedirs(run_dir)
+    event_path = os.path.join(run_dir, "event.json")
+    with open(event_path, "w") as f:
+        json.dump({
+            "issue": {"number": 1},
+            "comment": {"body": "/backport %s%s" % ("--dry-run " if options.dry_run else "", " ".join(branches))},
+            "repository": {"clone_url": url}
+        }, f)
+    metrics_path = os.path.join(run_dir, "metrics.json")
+    env = dict(os.environ, GITHUB_EVENT_PATH=event_path, GITHUB_API_URL=stub.url, GITHUB_REPOSITORY=REPOSITORY,
+        GITHUB_TOKEN="token", BACKPORT_METRICS_FILE=metrics_path)
+    env.pop("GITHUB_STEP_SUMMARY", None)
+    env.update(map(lambda x: x.split("=", 1), options.env))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backport_command.py")
+    start = time.monotonic()
+    result = subprocess.run([sys.executable, script], cwd=run_dir, env=env, capture_output=True, text=True)
+    wall_seconds = time.monotonic() - start
+    if result.returncode != 0:
+        logging.warning("Run %d failed with return code %d:\n%s" % (run, result.returncode, result.stdout + result.stderr))
+    with open(metrics_path) as f:
+        metrics = json.load(f)
+    # Pushed backport branches would make next run fail
+    origin = url[len("file://"):]
+    for ref in cmd("git -C %s for-each-ref --format='%%(refname)' refs/heads/backport" % origin)[0].split():
+        cmd("git -C %s update-ref -d %s" % (origin, ref))
+    shutil.rmtree(run_dir)
+    return {"return_code": result.returncode, "wall_seconds": round(wall_seconds, 6), "metrics": metrics}
+
+def get_medians(runs):
+    phases = {}
+    for run in runs:
+        for name, entry in run["metrics"]["summary"].items():
+            phases.setdefault(name, []).append(entry["total_seconds"])
+    return {
+        "wall_seconds": statistics.median(map(lambda x: x["wall_seconds"], runs)),
+        "subprocesses": statistics.median(map(lambda x: x["metrics"]["counters"]["subprocesses"], runs)),
+        "api_requests": statistics.median(map(lambda x: x["metrics"]["counters"]["api_requests"], runs)),
+        "phases": dict(map(lambda x: (x[0], statistics.median(x[1])), phases.items()))
+    }
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Benchmark backport command on synthetic repository against local stub API")
+    parser.add_argument("--files", type=int, default=2000, help="number of files in repository")
+    parser.add_argument("--dirs", type=int, default=20, help="number of directories files are spread over")
+    parser.add_argument("--file-size", type=int, default=1024, help="size of every file in bytes")
+    parser.add_argument("--history", type=int, default=20, help="number of commits on main and every release branch")
+    parser.add_argument("--branches", type=int, default=2, help="number of release branches to backport into")
+    parser.add_argument("--commits", type=int, default=5, help="number of PR commits")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs")
+    parser.add_argument("--seed", type=int, default=1, help="seed of generated content")
+    parser.add_argument("--dry-run", action="store_true", help="benchmark dry run backport")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+        help="environment variable of backport runs, e.g. BACKPORT_ENGINE=merge-tree (repeatable)")
+    parser.add_argument("--output", help="path of JSON file with results")
+    options = parser.parse_args(args)
+    for name, value in [("GIT_AUTHOR_NAME", "Benchmark"), ("GIT_AUTHOR_EMAIL", "benchmark@example.com"),
+            ("GIT_COMMITTER_NAME", "Benchmark"), ("GIT_COMMITTER_EMAIL", "benchmark@example.com")]:
+        os.environ.setdefault(name, value)
+    workdir = tempfile.mkdtemp(prefix="backport-benchmark-")
+    try:
+        start = time.monotonic()
+        url, branches = generate_repo(workdir, options)
+        logging.info("Generated repository in %.1fs" % (time.monotonic() - start))
+        stub = setup_stub(url)
+        try:
+            runs = []
+            for run in range(options.repeat):
+                runs.append(run_backport(workdir, url, branches, stub, options, run))
+                logging.info("Run %d: %.2fs, %d subprocesses, %d API requests" % (run + 1, runs[-1]["wall_seconds"],
+                    runs[-1]["metrics"]["counters"]["subprocesses"], runs[-1]["metrics"]["counters"]["api_requests"]))
+        finally:
+            stub.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    medians = get_medians(runs)
+    logging.info("\nMedian of %d runs:" % len(runs))
+    logging.info("%-16s %10s" % ("Phase", "Total"))
+    for name, seconds in medians["phases"].items():
+        logging.info("%-16s %9.2fs" % (name, seconds))
+    logging.info("%-16s %9.2fs" % ("wall time", medians["wall_seconds"]))
+    logging.info("%d subprocesses, %d API requests" % (medians["subprocesses"], medians["api_requests"]))
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump({
+                "parameters": dict(vars(options), output=None),
+                "git_version": cmd("git --version")[0],
+                "python_version": sys.version.split()[0],
+                "median": medians,
+                "runs": runs
+            }, f, indent=2)
+    return 1 if any(map(lambda x: x["return_code"] != 0, runs)) else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
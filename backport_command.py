@@ -22,6 +22,8 @@
 # ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 #
+import argparse
+import asyncio
 import logging
 import os
 import subprocess
@@ -31,14 +33,244 @@ import requests
 import shutil
 import sys
 import base64
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import hashlib
+import itertools
+import shlex
+import tempfile
+import threading
+import time
 import urllib
+from requests.adapters import HTTPAdapter
+
+# Number of keep-alive connections kept open to GitHub API
+HTTP_POOL_SIZE = 10
+# Timeouts (in seconds) of connecting to GitHub API and of waiting for response data
+HTTP_TIMEOUT = (10, 60)
+# Number of times a rate limited or failed API request is retried
+HTTP_RETRIES = 5
+# Initial delay (in seconds) between retries, doubled on every attempt
+HTTP_BACKOFF = 1
+# Longest delay (in seconds) we agree to wait for rate limit reset
+HTTP_MAX_WAIT = 120
+# Number of API requests issued concurrently by asyncio client
+API_CONCURRENCY = 4
+# Minimal interval (in seconds) between write API requests once GitHub rate limited a request
+API_WRITE_INTERVAL = 1
+# Delay (in seconds) of status comment update, updates made within it are coalesced into single write
+STATUS_DEBOUNCE = 2
+# How outcomes of backport into branch are shown in status comment
+STATUS_LABELS = {
+    "pending": ":hourglass: Pending",
+    "in-progress": ":arrows_counterclockwise: In progress",
+    "success": ":white_check_mark: Successful",
+    "dry-run-success": ":white_check_mark: Dry run successful",
+    "nothing-to-backport": ":fast_forward: Nothing to backport",
+    "failed": ":x: Failed"
+}
+# Default size limit (in MiB) of mirror cache directory
+CACHE_SIZE = 10240
+# Default size limit (in MiB) of HTTP response cache directory
+HTTP_CACHE_SIZE = 64
+# Default number of most recent commits of target branches fetched and checked for already backported changes
+HISTORY_DEPTH = 50
 
 class CommandException(Exception):
     def __init__(self, message):
         self.message = message
 
-def http_call(url, method = "GET", data = None):
-    full_url = "%s/%s" % (os.environ["GITHUB_API_URL"], url)
+class RunMetrics:
+    """Timings of phases of the run (clone, fetches, commit lookups, every cherry-pick, push, every API request)
+    and counts of subprocesses and API requests. Phases may be nested and, in parallel mode, overlap.
+    Attribute ran is set once backport of a PR or batch starts, runs which did neither write no metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.ran = False
+        self.phases = []
+        self.counters = {"subprocesses": 0, "api_requests": 0}
+
+    @contextlib.contextmanager
+    def phase(self, name, detail = None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, detail, time.monotonic() - start)
+
+    def add_phase(self, name, detail, seconds):
+        # Phase is added when it ends, its start is recorded relative to start of the run
+        start = time.monotonic() - seconds - self.start
+        with self.lock:
+            self.phases.append({"phase": name, "detail": detail, "start_seconds": round(start, 6), "seconds": round(seconds, 6)})
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get_summary(self):
+        # Returns dict of phase -> count, total and maximal time, in the order phases first occurred
+        summary = {}
+        with self.lock:
+            for phase in self.phases:
+                entry = summary.setdefault(phase["phase"], {"count": 0, "total_seconds": 0, "max_seconds": 0})
+                entry["count"] += 1
+                entry["total_seconds"] = round(entry["total_seconds"] + phase["seconds"], 6)
+                entry["max_seconds"] = max(entry["max_seconds"], phase["seconds"])
+        return summary
+
+    def to_dict(self):
+        summary = self.get_summary()
+        with self.lock:
+            return {
+                "total_seconds": round(time.monotonic() - self.start, 6),
+                "counters": dict(self.counters),
+                "summary": summary,
+                "phases": list(self.phases)
+            }
+
+    def render_summary(self):
+        # Returns metrics as markdown table for job summary
+        data = self.to_dict()
+        lines = [
+            "### Backport performance",
+            "",
+            "| Phase | Count | Total | Max |",
+            "|---|---:|---:|---:|"
+        ]
+        for name, entry in data["summary"].items():
+            lines.append("| %s | %d | %.2f s | %.2f s |" % (name, entry["count"], entry["total_seconds"], entry["max_seconds"]))
+        lines += ["", "Total run time %.2f s, %d subprocesses, %d API requests." % \
+            (data["total_seconds"], data["counters"]["subprocesses"], data["counters"]["api_requests"])]
+        return "\n".join(lines) + "\n"
+
+# Metrics of current run
+run_metrics = RunMetrics()
+
+def write_metrics(metrics_file):
+    # Writes metrics of the run to JSON file, if given, and as a table to job summary
+    if not run_metrics.ran:
+        return
+    if metrics_file:
+        with open(metrics_file, "w") as f:
+            json.dump(run_metrics.to_dict(), f, indent=2)
+    if os.environ.get("GITHUB_STEP_SUMMARY"):
+        with open(os.environ["GITHUB_STEP_SUMMARY"], "a") as f:
+            f.write(run_metrics.render_summary())
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_http_session():
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+    return http_session
+
+def is_rate_limited(response):
+    return response is not None and (response.status_code == 429 or \
+        (response.status_code == 403 and ("Retry-After" in response.headers or \
+        response.headers.get("X-RateLimit-Remaining") == "0")))
+
+def get_retry_delay(response, method, attempt):
+    # Returns number of seconds to wait before repeating request, or None if request should not be repeated
+    rate_limited = is_rate_limited(response)
+    # POST is not idempotent, so only repeat it when GitHub explicitly refused to process it
+    if not rate_limited and (method == "POST" or (response is not None and response.status_code < 500)):
+        return None
+    if attempt >= HTTP_RETRIES:
+        return None
+    delay = HTTP_BACKOFF * 2 ** attempt
+    if response is not None and "Retry-After" in response.headers:
+        delay = int(response.headers["Retry-After"])
+    elif response is not None and response.headers.get("X-RateLimit-Remaining") == "0" and \
+            "X-RateLimit-Reset" in response.headers:
+        delay = int(response.headers["X-RateLimit-Reset"]) - int(time.time()) + 1
+    if delay > HTTP_MAX_WAIT:
+        return None
+    return max(delay, 0)
+
+# Set once GitHub rate limited any request of the run, from then on asyncio client spaces out write requests
+rate_limit_hit = threading.Event()
+
+# Numbers of GET requests answered from HTTP response cache and fetched anew
+http_cache_stats = {"hits": 0, "misses": 0}
+http_cache_lock = threading.Lock()
+
+def get_http_cache_path(url):
+    return os.path.join(os.environ["BACKPORT_HTTP_CACHE_DIR"], "%s.json" % hashlib.sha256(url.encode()).hexdigest())
+
+def read_http_cache(url):
+    # Returns cached response for URL, or None if there is none
+    try:
+        with open(get_http_cache_path(url)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry if entry.get("url") == url else None
+
+def write_http_cache(url, response):
+    # Stores response, which has validators allowing it to be revalidated later
+    entry = {
+        "url": url,
+        "headers": dict(filter(lambda x: x[0] in ["ETag", "Last-Modified", "Link"], response.headers.items())),
+        "text": response.text
+    }
+    cache_dir = os.environ["BACKPORT_HTTP_CACHE_DIR"]
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(entry, f)
+    os.replace(temp_path, get_http_cache_path(url))
+    prune_http_cache(cache_dir, int(os.environ.get("BACKPORT_HTTP_CACHE_SIZE") or HTTP_CACHE_SIZE) * 1024 * 1024)
+
+def prune_http_cache(cache_dir, limit):
+    # Removes least recently used responses until cache fits into size limit. Cache hits touch
+    # their files, so modification time is the time of last use.
+    entries = []
+    for name in os.listdir(cache_dir):
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, name, stat.st_size))
+    total = sum(map(lambda x: x[2], entries))
+    for used, name, size in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def get_cached_response(url, entry):
+    # Builds response of not modified resource from cache entry
+    response = requests.models.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+    response.encoding = "utf-8"
+    response._content = entry["text"].encode()
+    return response
+
+def count_http_cache(url, hit):
+    with http_cache_lock:
+        http_cache_stats["hits" if hit else "misses"] += 1
+        logging.debug("::debug::HTTP cache %s for %s (hits: %d, misses: %d)" % \
+            ("hit" if hit else "miss", url, http_cache_stats["hits"], http_cache_stats["misses"]))
+
+def http_request(url, method = "GET", data = None):
+    # Relative URLs are resolved against GitHub API, absolute ones (e.g. from Link header) are used as is
+    full_url = url if re.match("^https?://", url) else "%s/%s" % (os.environ["GITHUB_API_URL"], url)
     headers = {
         "Accept": "application/vnd.github.v3+json",
         "Authorization": "Bearer %s" % os.environ["GITHUB_TOKEN"],
@@ -52,12 +284,47 @@ def http_call(url, method = "GET", data = None):
         if data is not None:
             logging.debug("::debug::Request:")
             logging.debug("::debug::    %s" % json.dumps(data))
-    if method == "GET":
-        response = requests.get(full_url, headers = headers)
-    elif method == "POST":
-        response = requests.post(full_url, headers = headers, data = json.dumps(data))
-    else:
+    if method not in ["GET", "POST", "PATCH"]:
         raise CommandException("Unsupported HTTP method %s" % method)
+    # Conditional requests answered with 304 Not Modified don't count against rate limit
+    cache_entry = None
+    if method == "GET" and os.environ.get("BACKPORT_HTTP_CACHE_DIR"):
+        cache_entry = read_http_cache(full_url)
+        if cache_entry is not None:
+            if "ETag" in cache_entry["headers"]:
+                headers["If-None-Match"] = cache_entry["headers"]["ETag"]
+            if "Last-Modified" in cache_entry["headers"]:
+                headers["If-Modified-Since"] = cache_entry["headers"]["Last-Modified"]
+    session = get_http_session()
+    attempt = 0
+    request_start = time.monotonic()
+    while True:
+        start = time.monotonic()
+        response = None
+        run_metrics.count("api_requests")
+        try:
+            response = session.request(method, full_url, headers = headers,
+                data = json.dumps(data) if data is not None else None, timeout = HTTP_TIMEOUT)
+            logging.debug("::debug::HTTP %s to %s returned %d in %.3fs" % \
+                (method, full_url, response.status_code, time.monotonic() - start))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            logging.debug("::debug::HTTP %s to %s failed in %.3fs: %s" % \
+                (method, full_url, time.monotonic() - start, e))
+            error = e
+        else:
+            if response.ok:
+                break
+        if is_rate_limited(response):
+            rate_limit_hit.set()
+        delay = get_retry_delay(response, method, attempt)
+        if delay is None:
+            break
+        logging.warning("::warning::HTTP %s to %s failed, retrying in %d seconds" % (method, full_url, delay))
+        time.sleep(delay)
+        attempt += 1
+    run_metrics.add_phase("api", "%s %s" % (method, full_url), time.monotonic() - request_start)
+    if response is None:
+        raise CommandException(str(error))
     if os.environ.get("RUNNER_DEBUG") == "1":
         logging.debug("::debug::Response:")
         for line in response.text.split("\n"):
@@ -66,7 +333,72 @@ def http_call(url, method = "GET", data = None):
         response.raise_for_status()
     except requests.exceptions.HTTPError as e:
         raise(CommandException(str(e)))
-    return json.loads(response.text)
+    if method == "GET" and os.environ.get("BACKPORT_HTTP_CACHE_DIR"):
+        if response.status_code == 304 and cache_entry is not None:
+            count_http_cache(full_url, True)
+            try:
+                os.utime(get_http_cache_path(full_url))
+            except FileNotFoundError:
+                pass
+            return get_cached_response(full_url, cache_entry)
+        count_http_cache(full_url, False)
+        if "ETag" in response.headers or "Last-Modified" in response.headers:
+            write_http_cache(full_url, response)
+    return response
+
+def http_call(url, method = "GET", data = None):
+    return json.loads(http_request(url, method, data).text)
+
+def http_paginate(url, per_page = 100):
+    # Generator over items of list endpoint, following Link: rel="next" headers. Items are yielded
+    # as soon as each page arrives, so consumer can start processing before the last page is fetched.
+    url = "%s%sper_page=%d" % (url, "&" if "?" in url else "?", per_page)
+    while url is not None:
+        response = http_request(url)
+        for item in json.loads(response.text):
+            yield item
+        url = response.links.get("next", {}).get("url")
+
+class ApiLimiter:
+    """Limits number of concurrent API requests issued by asyncio client. Once GitHub rate limited a request,
+    write requests are spaced out, as GitHub recommends to avoid hitting secondary rate limits again."""
+
+    def __init__(self, concurrency = None, write_interval = None):
+        self.semaphore = asyncio.Semaphore(concurrency or API_CONCURRENCY)
+        self.write_lock = asyncio.Lock()
+        self.write_interval = API_WRITE_INTERVAL if write_interval is None else write_interval
+        self.last_write = None
+
+    async def call(self, url, method = "GET", data = None):
+        async with self.semaphore:
+            if method != "GET" and rate_limit_hit.is_set():
+                async with self.write_lock:
+                    if self.last_write is not None:
+                        await asyncio.sleep(max(0, self.last_write + self.write_interval - time.monotonic()))
+                    self.last_write = time.monotonic()
+            return await asyncio.to_thread(http_call, url, method, data)
+
+async def http_call_async(url, method = "GET", data = None, limiter = None):
+    # Requests are issued by pooled HTTP session in worker threads, so they can run concurrently
+    if limiter is None:
+        return await asyncio.to_thread(http_call, url, method, data)
+    return await limiter.call(url, method, data)
+
+async def post_comment_async(pr_number, comment, limiter = None):
+    return await http_call_async(
+        "repos/%s/issues/%d/comments" % (os.environ["GITHUB_REPOSITORY"], pr_number),
+        "POST",
+        {"body": comment},
+        limiter
+    )
+
+async def create_pr_async(head, base, title, body, limiter = None):
+    return await http_call_async(
+        "repos/%s/pulls" % os.environ["GITHUB_REPOSITORY"],
+        "POST",
+        {"head": head, "base": base, "title": title, "body": body},
+        limiter
+    )
 
 def post_comment(pr_number, comment):
     return http_call(
@@ -75,6 +407,13 @@ def post_comment(pr_number, comment):
         {"body": comment}
     )
 
+def update_comment(comment_id, comment):
+    return http_call(
+        "repos/%s/issues/comments/%d" % (os.environ["GITHUB_REPOSITORY"], comment_id),
+        "PATCH",
+        {"body": comment}
+    )
+
 def create_pr(head, base, title, body):
     return http_call(
         "repos/%s/pulls" % os.environ["GITHUB_REPOSITORY"],
@@ -83,13 +422,278 @@ def create_pr(head, base, title, body):
     )
 
 def get_pr(pr_number):
+    if use_graphql():
+        return get_graphql_pr(pr_number)["pr"]
     return http_call("repos/%s/pulls/%d" % (os.environ["GITHUB_REPOSITORY"], pr_number))
 
 def get_pr_commits(pr_number):
-    return map(lambda x: x["sha"], http_call("repos/%s/pulls/%d/commits" % (os.environ["GITHUB_REPOSITORY"], pr_number)))
+    if use_graphql():
+        return iter(get_graphql_pr(pr_number)["commits"])
+    # Stays synchronous generator, so that commits can be processed while next pages are fetched
+    return map(lambda x: x["sha"], http_paginate("repos/%s/pulls/%d/commits" % (os.environ["GITHUB_REPOSITORY"], pr_number)))
+
+GRAPHQL_PR_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $branchQuery: String!, $cursor: String, $first: Boolean!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      number
+      title
+      url
+      headRefName
+      commits(first: 100, after: $cursor) {
+        totalCount
+        pageInfo { hasNextPage endCursor }
+        nodes { commit { oid messageHeadline parents { totalCount } author { name email date } } }
+      }
+    }
+    refs(refPrefix: "refs/heads/", query: $branchQuery, first: 100) @include(if: $first) {
+      nodes { name associatedPullRequests(states: OPEN, first: 1) { nodes { url } } }
+    }
+  }
+}
+"""
+
+# PR data fetched with GraphQL query, per PR number. Fetched once per run and shared by all target branches.
+graphql_pr_data = {}
+graphql_lock = threading.Lock()
+
+def use_graphql():
+    return os.environ.get("BACKPORT_GRAPHQL") == "true"
+
+def graphql_call(query, variables):
+    url = os.environ.get("GITHUB_GRAPHQL_URL") or "%s/graphql" % os.environ["GITHUB_API_URL"]
+    result = http_call(url, "POST", {"query": query, "variables": variables})
+    if result.get("errors"):
+        raise CommandException("GraphQL query failed:\n%s" % "\n".join(map(lambda x: x.get("message", ""), result["errors"])))
+    return result["data"]
+
+def get_graphql_pr(pr_number):
+    # Returns dict with PR data in the shape of REST API response ("pr"), list of PR commits ("commits")
+    # and backport branches of PR existing in repository, with URLs of their open PRs ("backport_branches").
+    # Metadata of PR commits is stored in commit cache, so that they don't need to be looked up in clone.
+    with graphql_lock:
+        if pr_number in graphql_pr_data:
+            return graphql_pr_data[pr_number]
+        owner, name = os.environ["GITHUB_REPOSITORY"].split("/", 1)
+        prefix = "backport/%d-to-" % pr_number
+        variables = {"owner": owner, "name": name, "number": pr_number, "branchQuery": prefix, "cursor": None, "first": True}
+        commits = []
+        while True:
+            repository = graphql_call(GRAPHQL_PR_QUERY, variables)["repository"]
+            pull_request = repository["pullRequest"]
+            if variables["first"]:
+                result = {
+                    "pr": {
+                        "number": pull_request["number"],
+                        "title": pull_request["title"],
+                        "head": {"ref": pull_request["headRefName"]},
+                        "commits": pull_request["commits"].get("totalCount"),
+                        "_links": {"html": {"href": pull_request["url"]}}
+                    },
+                    "commits": commits,
+                    # Ref query matches substrings of branch names
+                    "backport_branches": dict(map(lambda x: (x["name"],
+                        next(map(lambda y: y["url"], x["associatedPullRequests"]["nodes"]), None)),
+                        filter(lambda x: x["name"].startswith(prefix), repository["refs"]["nodes"])))
+                }
+            for node in pull_request["commits"]["nodes"]:
+                commit = node["commit"]
+                commits.append(commit["oid"])
+                with commit_info_lock:
+                    commit_info_cache[commit["oid"]] = {
+                        "sha": commit["oid"],
+                        "parents": commit["parents"]["totalCount"],
+                        "author_name": commit["author"]["name"],
+                        "author_email": commit["author"]["email"],
+                        "author_date": commit["author"]["date"],
+                        "subject": commit["messageHeadline"]
+                    }
+            page_info = pull_request["commits"]["pageInfo"]
+            if not page_info["hasNextPage"]:
+                break
+            variables.update({"cursor": page_info["endCursor"], "first": False})
+        logging.info("Fetched PR #%d with %d commits using GraphQL" % (pr_number, len(commits)))
+        graphql_pr_data[pr_number] = result
+        return result
+
+# API requests deferred by backport(). While main() collects them, coroutine functions taking ApiLimiter
+# are queued here instead of calling GitHub API, to be issued concurrently for all branches at the end.
+deferred_requests = None
+
+def run_with_deferred_requests(function):
+    # Runs function, then issues API requests it deferred. Returns sum of function result and number
+    # of failed requests.
+    global deferred_requests
+    deferred_requests = []
+    try:
+        return_code = function()
+        pending = deferred_requests
+    finally:
+        deferred_requests = None
+    if len(pending) == 0:
+        return return_code
+    logging.info("::group::Publishing results")
+    return_code += asyncio.run(issue_deferred_requests(pending))
+    logging.info("::endgroup::")
+    return return_code
+
+async def issue_deferred_requests(pending):
+    limiter = ApiLimiter()
+    return sum(await asyncio.gather(*map(lambda x: x(limiter), pending)))
+
+class StatusComment:
+    """Single PR comment aggregating outcomes of all target branches. It is created when backporting starts
+    and edited in place as branches finish. Updates are debounced, so that branches finishing in quick
+    succession are reported by single write."""
+
+    def __init__(self, pr_number, branches):
+        self.pr_number = pr_number
+        self.branches = dict(map(lambda x: (x, ("pending", None)), branches))
+        self.notes = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.timer = None
+        self.version = 0
+        self.written = 0
+        self.comment_id = post_comment(pr_number, self.render())["id"]
+
+    def update(self, branch, status, comment = None):
+        # Records status of branch, or general note when branch is None, and schedules write of comment
+        with self.lock:
+            if branch is None:
+                self.notes.append(comment)
+            else:
+                self.branches[branch] = (status, comment)
+            self.version += 1
+            if self.timer is None:
+                self.timer = threading.Timer(STATUS_DEBOUNCE, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        # Writes pending updates to comment right away. Returns 1 if update failed, 0 otherwise.
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                version = self.version
+                body = self.render()
+            if version == self.written:
+                return 0
+            try:
+                logging.debug("::debug::Updating status comment %d" % self.comment_id)
+                update_comment(self.comment_id, body)
+            except CommandException as e:
+                logging.error("::error::Error occurred while updating status comment of PR #%d" % self.pr_number)
+                logging.error(e.message)
+                return 1
+            self.written = version
+            return 0
+
+    def render(self):
+        lines = [
+            "Backport status:",
+            "",
+            "| Branch | Status |",
+            "|---|---|"
+        ]
+        for branch, (status, _) in self.branches.items():
+            lines.append("| `%s` | %s |" % (branch, STATUS_LABELS[status]))
+        for comment in list(map(lambda x: x[1], self.branches.values())) + self.notes:
+            if comment is not None:
+                lines += ["", comment]
+        return "\n".join(lines)
+
+# Status comment of PR being backported, when outcomes are reported in single comment rather than
+# comment per branch. Set by run_with_status_comment().
+status_comment = None
+
+def run_with_status_comment(pr_number, branches, function):
+    # Runs function, reporting everything it notifies about in single status comment. Returns sum
+    # of function result and 1 if final update of status comment failed.
+    global status_comment
+    try:
+        status_comment = StatusComment(pr_number, branches)
+    except CommandException as e:
+        logging.warning("::warning::Failed to create status comment, reporting results in separate comments")
+        logging.warning(e.message)
+        return function()
+    try:
+        return_code = function()
+    finally:
+        comment = status_comment
+        status_comment = None
+        flush_code = comment.flush()
+    return return_code + flush_code
+
+# Outcomes of backports per (PR number, branch), when they are collected for batch summary
+batch_results = None
+
+def record_result(pr_number, branch, status, comment):
+    if batch_results is not None and branch is not None:
+        batch_results[(pr_number, branch)] = {"status": status, "message": comment}
+
+def notify(pr_number, comment, branch = None, status = None):
+    # Records comment in status comment when there is one. Otherwise posts it to PR, or defers it
+    # when requests are being collected.
+    record_result(pr_number, branch, status, comment)
+    if status_comment is not None:
+        status_comment.update(branch, status, comment)
+    elif deferred_requests is None:
+        post_comment(pr_number, comment)
+    else:
+        deferred_requests.append(lambda limiter: notify_async(pr_number, comment, limiter))
+
+async def notify_async(pr_number, comment, limiter, branch = None, status = None):
+    record_result(pr_number, branch, status, comment)
+    if status_comment is not None:
+        status_comment.update(branch, status, comment)
+        return 0
+    try:
+        await post_comment_async(pr_number, comment, limiter)
+        return 0
+    except CommandException as e:
+        logging.error("::error::Error occurred while posting comment to PR #%d" % pr_number)
+        logging.error(e.message)
+        return 1
+
+async def open_backport_pr_async(pr_data, branch, backport_branch, skipped_note, limiter):
+    try:
+        new_pr_data = await create_pr_async(backport_branch, branch, "[Backport %s] %s" % (branch, pr_data["title"]), \
+            "Backport of %s" % pr_data["_links"]["html"]["href"], limiter)
+    except CommandException as e:
+        logging.error("::error::Error occurred while creating PR for backport into branch %s" % branch)
+        logging.error(e.message)
+        return max(1, await notify_async(pr_data["number"], ("Error occured while creating PR for backport into branch %s." +
+            "\n\n<details><summary>Error</summary><pre>%s</pre></details>") % (branch, e.message), limiter,
+            branch, "failed"))
+    logging.info("Created PR #%d for backport into branch %s" % (new_pr_data["number"], branch))
+    return await notify_async(pr_data["number"], ("Backporting into branch %s was successful. New PR: %s%s") % \
+        (branch, new_pr_data["html_url"], skipped_note), limiter, branch, "success")
 
-def cmd(cmd):
-    result = subprocess.run(cmd, shell=True, capture_output=True, check=False, text=True)
+# Per-thread state. Parallel backports run every target branch in its own thread and git worktree,
+# thread_state.cwd points cmd() to the worktree of current thread.
+thread_state = threading.local()
+# Serializes git commands writing shared repository metadata (config, list of worktrees) across worktrees
+git_config_lock = threading.Lock()
+
+@contextlib.contextmanager
+def lock_repository_metadata():
+    # Holds git_config_lock and, when working in a worktree of cached mirror, exclusive lock on <mirror>.lock,
+    # as the mirror config and list of worktrees are shared with concurrent runs in other processes
+    with git_config_lock:
+        if mirror_cache is None:
+            yield
+            return
+        with open("%s.lock" % mirror_cache["mirror"], "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+def cmd(cmd, input = None):
+    run_metrics.count("subprocesses")
+    result = subprocess.run(cmd, shell=True, capture_output=True, check=False, text=True, input=input,
+        cwd=getattr(thread_state, "cwd", None))
     if os.environ.get("RUNNER_DEBUG"):
         logging.debug("::debug::Running command:")
         logging.debug("::debug::    %s" % cmd)
@@ -102,78 +706,639 @@ def cmd(cmd):
         raise(CommandException("\n".join([cmd, result.stdout, result.stderr])))
     return (result.stdout.strip(), result.stderr.strip())
 
-def clone(url, branches, pr_number, auth_header):
+def clone(url, branches, pr_numbers, auth_header, pr_commits = None, notify_error = True):
+    # pr_commits is the largest number of commits of PRs, None if not known. Returns error message
+    # when cloning failed, which is also posted to PRs unless notify_error is False.
     try:
         dir = os.path.basename(os.environ["GITHUB_REPOSITORY"])
-        git = "git -c \"%s\"" % auth_header
+        git = "git %s" % git_auth(auth_header)
         logging.info("Cleaning up directory %s" % dir)
         shutil.rmtree(dir, ignore_errors=True)
         logging.info("Cloning repository %s into directory %s"  % (url, dir))
-        # Make a shallow clone (depth=1) of single default branch
-        cmd("%s clone --depth=1 -q %s %s" % (git, url, dir))
+        if os.environ.get("BACKPORT_CACHE_DIR"):
+            cached_clone(url, branches, pr_numbers, auth_header, dir, os.environ["BACKPORT_CACHE_DIR"])
+            return None
+        if os.environ.get("BACKPORT_PARTIAL_CLONE") == "true":
+            partial_clone(url, branches, pr_numbers, auth_header, dir, pr_commits)
+            return None
+        # Make a shallow clone (depth=1) of single default branch. In sparse mode only files in its root
+        # directory are checked out.
+        cmd("%s clone --depth=1 -q %s %s %s" % (git, "--sparse" if use_sparse_checkout() else "", url, dir))
         os.chdir(dir)
         # Fetch backport target branches, so that we can checkout them later
         branch_list = " ".join(branches)
         cmd("%s remote set-branches origin %s" % (git, branch_list))
-        cmd("%s fetch --depth=1 origin %s" % (git, branch_list))
+        with run_metrics.phase("fetch", "branches"):
+            cmd("%s fetch --depth=%d origin %s" % (git, get_fetch_depth(), branch_list))
         # Github stores refs to pr commits in refs/pull/<pr_number>/head for 90 days.
         # Fetching it to cherry-pick individual commits from it later.
-        cmd("%s fetch origin refs/pull/%d/head" % (git, pr_number))
+        with run_metrics.phase("fetch", "PR heads"):
+            cmd("%s fetch origin %s" % (git, " ".join(map(lambda x: "refs/pull/%d/head" % x, pr_numbers))))
+        return None
     except CommandException as e:
         logging.error("::error::Error occurred while cloning repo %s" % url)
         logging.error(e.message)
-        post_comment(pr_number, ("Error occured while cloning repo %s." +
-                "\n\n<details><summary>Error</summary><pre>%s</pre></details>") % (url, e.message))
+        message = ("Error occured while cloning repo %s." +
+            "\n\n<details><summary>Error</summary><pre>%s</pre></details>") % (url, e.message)
+        if notify_error:
+            for pr_number in pr_numbers:
+                notify(pr_number, message)
+        return message
+
+def export_git_auth(auth_header):
+    # On-demand fetches of partial clone are run by git itself, so the auth header is passed to
+    # every git process via environment rather than via command line or stored repository config
+    auth_key, auth_value = auth_header.split("=", 1)
+    os.environ["GIT_CONFIG_COUNT"] = "1"
+    os.environ["GIT_CONFIG_KEY_0"] = auth_key
+    os.environ["GIT_CONFIG_VALUE_0"] = auth_value
+
+def git_auth(auth_header):
+    # Returns git option passing the auth header, empty once the header is exported to environment:
+    # http.extraheader is multi-valued, and GitHub rejects requests with duplicate Authorization header
+    if "%s=%s" % (os.environ.get("GIT_CONFIG_KEY_0"), os.environ.get("GIT_CONFIG_VALUE_0")) == auth_header:
+        return ""
+    return "-c \"%s\"" % auth_header
+
+def get_fetch_refspecs(branches, pr_numbers):
+    refspecs = list(map(lambda x: "+refs/heads/%s:refs/remotes/origin/%s" % (x, x), branches))
+    refspecs += map(lambda x: "+refs/pull/%d/head:refs/pull/%d/head" % (x, x), pr_numbers)
+    return " ".join(refspecs)
+
+def partial_clone(url, branches, pr_numbers, auth_header, dir, pr_commits):
+    # Blobless clone without checkout: commits and trees of target branches and PR are fetched
+    # with single request, file contents are fetched on demand when cherry-pick needs them.
+    # History is bounded like in shallow clone. Depth applies to all refs of the request, so it covers
+    # both history of target branches and all PR commits with their parents.
+    depth = ""
+    if pr_commits is not None:
+        depth = "--depth=%d" % max(get_fetch_depth(), pr_commits + 1)
+    cmd("git init -q %s" % dir)
+    os.chdir(dir)
+    cmd("git remote add %s origin %s" % (" ".join(map(lambda x: "-t %s" % x, branches)), url))
+    cmd("git config remote.origin.promisor true")
+    cmd("git config remote.origin.partialclonefilter blob:none")
+    export_git_auth(auth_header)
+    with run_metrics.phase("fetch", "branches and PR heads"):
+        cmd("git fetch -q --filter=blob:none %s origin %s" % (depth, get_fetch_refspecs(branches, pr_numbers)))
+
+# Mirror cache used by current run: mirror path, worktree path, lock files and backport branches to
+# be removed from the mirror once the run is finished
+mirror_cache = None
+
+def cached_clone(url, branches, pr_numbers, auth_header, dir, cache_dir):
+    # Bare mirror of the repository is kept in cache directory between runs and updated incrementally,
+    # working copy is created as a worktree of it. Every run holds shared lock on <mirror>.use for
+    # its whole duration, so that pruning never removes a mirror which is in use, and exclusive lock
+    # on <mirror>.lock while updating the mirror.
+    global mirror_cache
+    mirror = os.path.join(os.path.abspath(cache_dir), "%s.git" % os.environ["GITHUB_REPOSITORY"])
+    worktree = os.path.abspath(dir)
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+    use_lock = open("%s.use" % mirror, "a")
+    fcntl.flock(use_lock, fcntl.LOCK_SH)
+    os.utime("%s.use" % mirror)
+    mirror_cache = {
+        "mirror": mirror,
+        "worktree": worktree,
+        "use_lock": use_lock,
+        "branches": list(map(lambda x: "backport/%d-to-%s" % x, itertools.product(pr_numbers, branches)))
+    }
+    with open("%s.lock" % mirror, "a") as update_lock:
+        fcntl.flock(update_lock, fcntl.LOCK_EX)
+        git = "git -C %s" % mirror
+        if not os.path.isdir(mirror):
+            logging.info("Creating mirror %s" % mirror)
+            cmd("git init -q --bare %s" % mirror)
+            cmd("%s remote add origin %s" % (git, url))
+        else:
+            logging.info("Updating mirror %s" % mirror)
+            cmd("%s remote set-url origin %s" % (git, url))
+        # Drop worktrees of previous runs and leftovers of interrupted attempts to backport this PR
+        cmd("%s worktree prune" % git)
+        delete_local_branches(git, mirror_cache["branches"])
+        filter = ""
+        if os.environ.get("BACKPORT_PARTIAL_CLONE") == "true":
+            cmd("%s config remote.origin.promisor true" % git)
+            cmd("%s config remote.origin.partialclonefilter blob:none" % git)
+            export_git_auth(auth_header)
+            filter = "--filter=blob:none"
+        with run_metrics.phase("fetch", "branches and PR heads"):
+            cmd("git %s -C %s fetch -q %s origin %s" % (git_auth(auth_header), mirror, filter, get_fetch_refspecs(branches, pr_numbers)))
+        add_worktree(git, worktree, "origin/%s" % branches[0])
+    os.chdir(worktree)
+    prune_cache(os.path.dirname(os.path.dirname(mirror)), mirror)
+
+def use_sparse_checkout():
+    return os.environ.get("BACKPORT_SPARSE_CHECKOUT") == "true"
+
+def add_worktree(git, worktree, commit):
+    # Adds worktree with detached HEAD at commit. In sparse mode only files in root directory are checked out,
+    # backport() extends sparse checkout with directories changed by PR.
+    if not use_sparse_checkout():
+        cmd("%s worktree add -q --detach %s %s" % (git, worktree, commit))
+        return
+    cmd("%s worktree add -q --no-checkout --detach %s %s" % (git, worktree, commit))
+    cmd("git -C %s sparse-checkout set --cone" % worktree)
+    cmd("git -C %s reset -q --hard" % worktree)
+
+def get_changed_dirs(commits):
+    # Returns sorted list of directories with files changed by commits, looked up with single git invocation.
+    # Merge commits don't contribute, as they are not backported.
+    output = cmd("git diff-tree --stdin -r -z --name-only --no-commit-id", "\n".join(commits) + "\n")[0]
+    return sorted(set(filter(None, map(os.path.dirname, filter(None, output.split("\0"))))))
+
+def set_sparse_checkout(commits):
+    dirs = get_changed_dirs(commits)
+    logging.info("Limiting sparse checkout to %d directories changed by PR" % len(dirs))
+    with lock_repository_metadata():
+        cmd("git sparse-checkout set --cone --stdin", "".join(map(lambda x: x + "\n", dirs)))
+
+def cherry_pick(commit, commit_info):
+    # In sparse mode git updates paths outside of sparse checkout itself, and checks out conflicted ones
+    cmd("git %s cherry-pick %s -x" % (get_identity_options(commit_info), commit))
+
+def delete_local_branches(git, branches):
+    existing = cmd("%s for-each-ref --format=\"%%(refname:lstrip=2)\" %s" % \
+        (git, " ".join(map(lambda x: "refs/heads/%s" % x, branches))))[0].split()
+    if len(existing) > 0:
+        cmd("%s branch -q -D %s" % (git, " ".join(existing)))
+
+def get_dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
+
+def prune_cache(cache_dir, current_mirror):
+    # Removes least recently used mirrors until cache fits into size limit. Mirrors in use by
+    # other runs are skipped, the mirror of current run is never removed.
+    limit = int(os.environ.get("BACKPORT_CACHE_SIZE") or CACHE_SIZE) * 1024 * 1024
+    mirrors = []
+    for owner in os.listdir(cache_dir):
+        owner_dir = os.path.join(cache_dir, owner)
+        if os.path.isdir(owner_dir):
+            for name in os.listdir(owner_dir):
+                mirror = os.path.join(owner_dir, name)
+                if name.endswith(".git") and os.path.isdir(mirror):
+                    used = os.path.getmtime("%s.use" % mirror) if os.path.exists("%s.use" % mirror) else 0
+                    mirrors.append((used, mirror, get_dir_size(mirror)))
+    total = sum(map(lambda x: x[2], mirrors))
+    for used, mirror, size in sorted(mirrors):
+        if total <= limit:
+            break
+        if mirror == current_mirror:
+            continue
+        with open("%s.use" % mirror, "a") as use_lock:
+            try:
+                fcntl.flock(use_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            logging.info("Removing mirror %s from cache" % mirror)
+            shutil.rmtree(mirror, ignore_errors=True)
+            total -= size
+
+def release_clone():
+    # Removes worktree and local backport branches of current run from the mirror cache
+    global mirror_cache
+    if mirror_cache is None:
+        return
+    os.chdir(os.path.dirname(mirror_cache["worktree"]))
+    git = "git -C %s" % mirror_cache["mirror"]
+    try:
+        with lock_repository_metadata():
+            cmd("%s worktree remove --force %s" % (git, mirror_cache["worktree"]))
+            delete_local_branches(git, mirror_cache["branches"])
+    except CommandException as e:
+        logging.warning("::warning::Failed to clean up mirror %s" % mirror_cache["mirror"])
+        logging.warning(e.message)
+    mirror_cache["use_lock"].close()
+    mirror_cache = None
+
+# Number of commits looked up by single git invocation
+COMMIT_BATCH_SIZE = 100
+
+# Metadata of already looked up commits, shared by all target branches of the run
+commit_info_cache = {}
+commit_info_lock = threading.Lock()
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+def get_commits_info(commits):
+    # Returns list of dicts with parent count, author name, email, date and subject for every commit,
+    # looking up all commits missing in cache with single git invocation.
+    with commit_info_lock:
+        missing = list(dict.fromkeys(commit for commit in commits if commit not in commit_info_cache))
+        if len(missing) > 0:
+            with run_metrics.phase("commit-lookup", "%d commits" % len(missing)):
+                output = cmd("git log --no-walk=unsorted --stdin --date=raw --format=\"%H%x00%P%x00%an%x00%ae%x00%ad%x00%s\"",
+                    "\n".join(missing) + "\n")[0]
+            for commit, line in zip(missing, output.split("\n")):
+                sha, parents, author_name, author_email, author_date, subject = line.split("\x00")
+                commit_info_cache[commit] = {
+                    "sha": sha,
+                    "parents": len(parents.split()),
+                    "author_name": author_name,
+                    "author_email": author_email,
+                    "author_date": author_date,
+                    "subject": subject
+                }
+        return [commit_info_cache[commit] for commit in commits]
 
 def is_merge_commit(commit):
-    commit_data = cmd("git show %s --compact-summary" % commit)
-    return True if re.search("^Merge:", commit_data[0], re.MULTILINE) else False
+    return get_commits_info([commit])[0]["parents"] > 1
+
+def get_history_depth():
+    return int(os.environ.get("BACKPORT_HISTORY_DEPTH") or HISTORY_DEPTH)
+
+def get_fetch_depth():
+    # History depth 0 disables lookup of changes already present in target branches, but the fetch
+    # still needs the branch head
+    return max(get_history_depth(), 1)
+
+# Patch ids of already looked up PR commits and sets of patch ids of recent commits of target branches,
+# shared by all target branches of the run
+patch_id_cache = {}
+branch_patch_ids = {}
+patch_id_lock = threading.Lock()
+
+def parse_patch_ids(output):
+    # Parses 'git patch-id' output into dict of commit -> patch id
+    return dict(map(lambda x: reversed(x.split()), filter(None, output.split("\n"))))
+
+def prefetch_blobs(log_options, input = None):
+    # In partial clone git downloads file contents needed by diffs of 'git log -p' on demand, with
+    # a request per commit. Downloads contents needed by diffs of all selected commits with single request.
+    if os.environ.get("BACKPORT_PARTIAL_CLONE") != "true":
+        return
+    output = cmd("git log --raw --no-abbrev --no-color --format= %s" % log_options, input)[0]
+    blobs = set(filter(lambda x: x.strip("0"), itertools.chain.from_iterable(
+        map(lambda x: x.split()[2:4], filter(None, output.split("\n"))))))
+    if len(blobs) > 0:
+        cmd("git -c fetch.negotiationAlgorithm=noop fetch -q --no-tags --no-write-fetch-head --recurse-submodules=no " + \
+            "--filter=blob:none --stdin origin", "".join(map(lambda x: x + "\n", blobs)))
+
+def get_patch_ids(commits):
+    # Returns dict of commit -> patch id (commits with empty diff are missing), computing patch ids of
+    # all commits missing in cache with single git invocation
+    with patch_id_lock:
+        missing = list(dict.fromkeys(commit for commit in commits if commit not in patch_id_cache))
+        if len(missing) > 0:
+            with run_metrics.phase("commit-lookup", "patch ids of %d commits" % len(missing)):
+                prefetch_blobs("--no-walk=unsorted --stdin", "\n".join(missing) + "\n")
+                patch_ids = parse_patch_ids(cmd("git log --no-walk=unsorted --stdin -p --no-color --format=\"commit %H\" | " + \
+                    "git patch-id --stable", "\n".join(missing) + "\n")[0])
+            for commit in missing:
+                patch_id_cache[commit] = patch_ids.get(get_commits_info([commit])[0]["sha"])
+        return dict((commit, patch_id_cache[commit]) for commit in commits)
+
+def get_branch_patch_ids(branch):
+    # Returns set of patch ids of recent commits of target branch. Sets are keyed by branch head commit,
+    # so that they are never reused for another state of the branch. Shallow boundary commits are excluded:
+    # git diffs them as root commits, adding the whole tree. History depth 0 disables the lookup.
+    if get_history_depth() == 0:
+        return set()
+    head = cmd("git rev-parse origin/%s" % branch)[0]
+    with patch_id_lock:
+        if head in branch_patch_ids:
+            return branch_patch_ids[head]
+    # Computed without holding the lock, so that target branches don't wait for each other
+    with run_metrics.phase("commit-lookup", "patch ids of branch %s" % branch):
+        revisions = "--no-merges -n %d %s --not $(cat \"$(git rev-parse --git-path shallow)\" 2>/dev/null)" % \
+            (get_history_depth(), head)
+        prefetch_blobs(revisions)
+        patch_ids = set(parse_patch_ids(cmd("git log -p --no-color --format=\"commit %%H\" %s | git patch-id --stable" % \
+            revisions)[0]).values())
+    with patch_id_lock:
+        return branch_patch_ids.setdefault(head, patch_ids)
+
+def get_commits_to_apply(branch, commits, skipped):
+    # Yields tuples of commit and its info for PR commits to be applied on target branch, omitting merge
+    # commits and commits which are already present in the branch (those are appended to skipped list)
+    applied = get_branch_patch_ids(branch)
+    for batch in batched(commits, COMMIT_BATCH_SIZE):
+        patch_ids = get_patch_ids(batch)
+        for commit, commit_info in zip(batch, get_commits_info(batch)):
+            if commit_info["parents"] > 1:
+                logging.info("Ommitting merge commit %s" % commit)
+            elif patch_ids[commit] is not None and patch_ids[commit] in applied:
+                logging.info("Skipping commit %s, its changes are already present in branch %s" % (commit, branch))
+                skipped.append(commit)
+            else:
+                yield (commit, commit_info)
+
+@functools.lru_cache(maxsize=None)
+def get_git_version():
+    return tuple(map(int, re.findall("[0-9]+", cmd("git --version")[0])[:3]))
+
+def use_merge_tree():
+    if os.environ.get("BACKPORT_ENGINE") != "merge-tree":
+        return False
+    if get_git_version() < (2, 38):
+        logging.warning("::warning::merge-tree engine requires git 2.38 or newer, using cherry-pick")
+        return False
+    return True
+
+def get_identity_options(commit_info):
+    return "-c user.name=%s -c user.email=%s" % \
+        (shlex.quote(commit_info["author_name"]), shlex.quote(commit_info["author_email"]))
+
+def merge_commit_tree(head, commit, commit_info):
+    # Computes tree resulting from cherry-picking commit on top of head, without touching working tree
+    # or index. Returns tuple of tree and list of conflicted paths (tree has conflict markers then).
+    # Before git 2.40 merge-tree has no --merge-base option and always merges relative to merge base
+    # of its arguments, so head tree is first recreated as a child of commit parent to make it the base.
+    rebased_head = cmd("git %s commit-tree %s^{tree} -p %s^ -m %s" % \
+        (get_identity_options(commit_info), head, commit, shlex.quote("Rebased %s" % head)))[0]
+    # Exit code 1 means merge has conflicts, higher codes are errors
+    output = cmd("git merge-tree --write-tree --name-only --no-messages %s %s || test $? -eq 1" % \
+        (rebased_head, commit))[0].split("\n")
+    return (output[0], output[1:])
+
+def commit_replayed_tree(tree, head, commit, commit_info):
+    # Creates commit of tree on top of head with message and author of original commit, adding the same
+    # "cherry picked from" line as 'git cherry-pick -x' does
+    message = cmd("git cat-file commit %s" % commit)[0].partition("\n\n")[2].strip()
+    paragraphs = message.split("\n\n")
+    has_trailers = len(paragraphs) > 1 and all(map(lambda x: re.match("^([A-Za-z0-9-]+: |\\(cherry picked from commit )", x),
+        paragraphs[-1].split("\n")))
+    message += "%s(cherry picked from commit %s)\n" % ("\n" if has_trailers else "\n\n", commit)
+    return cmd("GIT_AUTHOR_NAME=%s GIT_AUTHOR_EMAIL=%s GIT_AUTHOR_DATE=%s git %s commit-tree %s -p %s" % \
+        (shlex.quote(commit_info["author_name"]), shlex.quote(commit_info["author_email"]),
+        shlex.quote(commit_info["author_date"]), get_identity_options(commit_info), tree, head), message)[0]
+
+def replay_commits(backport_branch, branch, commits, skipped):
+    # Replays commits on top of target branch in object database and creates backport branch pointing
+    # to result. Returns None on success. If a commit can not be replayed cleanly, returns iterable over
+    # all commits, so that they can be cherry-picked in working tree to report conflict.
+    head = cmd("git rev-parse origin/%s" % branch)[0]
+    commits = iter(commits)
+    consumed = []
+    def consume():
+        for commit in commits:
+            consumed.append(commit)
+            yield commit
+    for commit, commit_info in get_commits_to_apply(branch, consume(), skipped):
+        if commit_info["parents"] == 1:
+            logging.info("Replaying commit %s" % commit)
+            with run_metrics.phase("replay", "%s onto %s" % (commit, branch)):
+                tree, conflicts = merge_commit_tree(head, commit, commit_info)
+                if len(conflicts) == 0:
+                    head = commit_replayed_tree(tree, head, commit, commit_info)
+            if len(conflicts) == 0:
+                continue
+            logging.info("Commit %s conflicts in %s" % (commit, ", ".join(conflicts)))
+        logging.info("Can not replay commit %s, falling back to cherry-pick" % commit)
+        return itertools.chain(consumed, commits)
+    cmd("git update-ref refs/heads/%s %s" % (backport_branch, head))
+    return None
+
+def get_branch_conflicts(branch, commits):
+    # Replays commits on top of target branch in object database and returns list with conflicted paths
+    # for every commit (None for merge commits, which are not backported, True for commits already
+    # present in the branch). Commits following a conflicted
+    # one are replayed on top of tree with conflict markers, as if conflict was resolved by committing it.
+    head = cmd("git rev-parse origin/%s" % branch)[0]
+    applied = get_branch_patch_ids(branch)
+    patch_ids = get_patch_ids(list(map(lambda x: x[0], commits)))
+    result = []
+    for commit, commit_info in commits:
+        if commit_info["parents"] != 1:
+            result.append(None)
+            continue
+        if patch_ids[commit] is not None and patch_ids[commit] in applied:
+            result.append(True)
+            continue
+        tree, conflicts = merge_commit_tree(head, commit, commit_info)
+        head = commit_replayed_tree(tree, head, commit, commit_info)
+        result.append(conflicts)
+    return result
+
+def conflict_matrix(branches, pr_number, parallel):
+    # Dry run checking which PR commits conflict on which target branches, without touching working tree.
+    # All branches are evaluated in parallel and the result is posted as a single table. Returns number
+    # of branches PR can not be backported into.
+    logging.info("::group::Computing conflict matrix of PR #%d for branches %s" % (pr_number, ", ".join(branches)))
+    if get_git_version() < (2, 38):
+        logging.error("::error::Conflict matrix requires git 2.38 or newer")
+        post_comment(pr_number, "Conflict matrix requires git 2.38 or newer on the runner.")
+        logging.info("::endgroup::")
+        return len(branches)
+    logging.info("Fetching list of PR commits")
+    commits = list(get_pr_commits(pr_number))
+    commits = list(zip(commits, get_commits_info(commits)))
+    columns = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(get_branch_conflicts, branch, commits) for branch in branches]
+        for branch, future in zip(branches, futures):
+            try:
+                columns.append(future.result())
+            except CommandException as e:
+                logging.error("::error::Error occurred while computing conflicts for branch %s" % branch)
+                logging.error(e.message)
+                columns.append(e)
+    escape = lambda x: x.replace("|", "\\|")
+    lines = [
+        "Conflict matrix for backporting into branches:",
+        "",
+        "| Commit | %s |" % " | ".join(map(lambda x: "`%s`" % x, branches)),
+        "|---|%s" % ("---|" * len(branches))
+    ]
+    for i, (commit, commit_info) in enumerate(commits):
+        cells = []
+        for column in columns:
+            if isinstance(column, CommandException):
+                cells.append(":warning: error")
+            elif column[i] is None:
+                cells.append(":heavy_minus_sign: merge commit, omitted")
+            elif column[i] is True:
+                cells.append(":fast_forward: already in branch")
+            elif len(column[i]) == 0:
+                cells.append(":white_check_mark:")
+            else:
+                cells.append(":x: %s" % ", ".join(map(lambda x: "`%s`" % escape(x), column[i])))
+        lines.append("| %s %s | %s |" % (commit_info["sha"][:7], escape(commit_info["subject"]), " | ".join(cells)))
+    return_code = 0
+    for branch, column in zip(branches, columns):
+        if isinstance(column, CommandException):
+            lines.append("\n<details><summary>Error for branch %s</summary><pre>%s</pre></details>" % (branch, column.message))
+            return_code += 1
+        elif any(map(lambda x: isinstance(x, list) and len(x) > 0, column)):
+            return_code += 1
+    logging.info("\n".join(lines))
+    post_comment(pr_number, "\n".join(lines))
+    logging.info("::endgroup::")
+    return return_code
 
 def backport(branch, pr_data, dry_run, auth_header):
     pr_number = pr_data["number"]
     return_code = 0
+    start = time.monotonic()
     action = "Dry run backporting" if dry_run else "Backporting"
     logging.info("::group::%s PR #%d into branch %s" % (action, pr_number, branch))
+    if status_comment is not None:
+        status_comment.update(branch, "in-progress")
     try:
         backport_branch = "backport/%d-to-%s" % (pr_number, branch)
-        if ("origin/%s" % backport_branch) in re.split("\s+", cmd("git branch -r")[0]):
-            raise CommandException(("Branch `%s` already exists. It looks like backporting of this PR into branch\n" + \
-                "`%s` had already been performed. To repeat backporting, you'll need to cleanup previous attempt first\n" + \
-                "by deleting branch `%s`. If backport PR had already been created, it will be closed\n" +
-                "automatically when branch is deleted.") % (backport_branch, branch, backport_branch))
-        logging.info("Checking out branch %s from origin/%s" % (backport_branch, branch))
-        cmd("git checkout -b %s -t origin/%s" % (backport_branch, branch))
-        logging.info("Fetching list of PR commits to cherry-pick")
-        commits = get_pr_commits(pr_number)
-        for commit in commits:
-            if is_merge_commit(commit):
-                logging.info("Ommitting merge commit %s" % commit)
-            else:
+        existing_branches = remote_backport_branches.get(pr_number)
+        if existing_branches is None:
+            existing_branches = get_remote_backport_branches("origin", pr_number, auth_header)
+        if backport_branch in existing_branches:
+            raise CommandException(get_branch_exists_message(backport_branch, branch))
+        commits = None
+        skipped = []
+        if use_merge_tree():
+            logging.info("Fetching list of PR commits to replay")
+            commits = replay_commits(backport_branch, branch, get_pr_commits(pr_number), skipped)
+        if not use_merge_tree() or commits is not None:
+            if commits is None:
+                logging.info("Fetching list of PR commits to cherry-pick")
+                commits = get_pr_commits(pr_number)
+            if use_sparse_checkout():
+                commits = list(commits)
+                set_sparse_checkout(commits)
+            logging.info("Checking out branch %s from origin/%s" % (backport_branch, branch))
+            with lock_repository_metadata():
+                cmd("git checkout -b %s -t origin/%s" % (backport_branch, branch))
+            skipped = []
+            for commit, commit_info in get_commits_to_apply(branch, commits, skipped):
                 logging.info("Cherry-picking commit %s" % commit)
-                user_name = cmd("git log -1 --format=\"%%an\" %s" % commit)[0]
-                user_email = cmd("git log -1 --format=\"%%ae\" %s" % commit)[0]
-                cmd("git -c user.name=\"%s\" -c user.email=\"%s\" cherry-pick %s -x" % \
-                    (user_name, user_email, commit))
-        if dry_run:
+                with run_metrics.phase("cherry-pick", "%s into %s" % (commit, branch)):
+                    cherry_pick(commit, commit_info)
+        skipped_note = ""
+        if len(skipped) > 0:
+            skipped_note = "\n\nSkipped commits already present in branch %s: %s" % (branch, ", ".join(skipped))
+        if cmd("git rev-list --count origin/%s..%s" % (branch, backport_branch))[0] == "0" and len(skipped) > 0:
+            logging.info("All changes of PR are already present in branch %s, nothing to backport" % branch)
+            notify(pr_number, "All changes of this PR are already present in branch %s, nothing to backport.%s" % \
+                (branch, skipped_note), branch, "nothing-to-backport")
+        elif dry_run:
             logging.info("Skip pushing branches and creating backport PRs in dry run mode")
-            post_comment(pr_number, "Dry run backporting into branch %s was successful." % branch)
+            notify(pr_number, "Dry run backporting into branch %s was successful.%s" % (branch, skipped_note), \
+                branch, "dry-run-success")
         else:
             logging.info("Pushing branch %s" % backport_branch)
-            cmd("git -c \"%s\" push origin --set-upstream %s" % (auth_header, backport_branch))
-            logging.info("Creating new PR for backport into branch %s" % branch)
-            new_pr_data = create_pr(backport_branch, branch, "[Backport %s] %s" % ( branch, pr_data["title"]), \
-                "Backport of %s" % pr_data["_links"]["html"]["href"])
-            logging.info("Created PR #%d" % new_pr_data["number"])
-            post_comment(pr_number, ("Backporting into branch %s was successful. New PR: %s") % (branch, new_pr_data["html_url"]))
+            with run_metrics.phase("push", backport_branch):
+                cmd("git %s push origin %s" % (git_auth(auth_header), backport_branch))
+            # Same upstream settings as 'push --set-upstream' writes, without holding the lock for the whole push.
+            # Remote-tracking branch doesn't exist when fetch refspecs are limited to target branches.
+            with lock_repository_metadata():
+                cmd("git config branch.%s.remote origin && git config branch.%s.merge refs/heads/%s" % \
+                    (backport_branch, backport_branch, backport_branch))
+            if deferred_requests is not None:
+                logging.info("Deferring creation of PR for backport into branch %s" % branch)
+                deferred_requests.append(lambda limiter: \
+                    open_backport_pr_async(pr_data, branch, backport_branch, skipped_note, limiter))
+            else:
+                logging.info("Creating new PR for backport into branch %s" % branch)
+                new_pr_data = create_pr(backport_branch, branch, "[Backport %s] %s" % ( branch, pr_data["title"]), \
+                    "Backport of %s" % pr_data["_links"]["html"]["href"])
+                logging.info("Created PR #%d" % new_pr_data["number"])
+                notify(pr_number, ("Backporting into branch %s was successful. New PR: %s%s") % \
+                    (branch, new_pr_data["html_url"], skipped_note), branch, "success")
     except CommandException as e:
-        logging.error("::error::Error occurred while %s into branch %s" % (action.lower(), branch))
-        logging.error(e.message)
-        post_comment(pr_number, ("Error occured while %s into branch %s." +
-                "\n\n<details><summary>Error</summary><pre>%s</pre></details>") % (action.lower(), branch, e.message))
+        report_backport_error(pr_number, action, branch, e.message)
         return_code = 1
+    run_metrics.add_phase("backport", "PR #%d into %s" % (pr_number, branch), time.monotonic() - start)
     logging.info("::endgroup::")
     return return_code
 
+# Backport branches existing in remote repository, per PR number. Looked up by main() once per run.
+remote_backport_branches = {}
+
+def get_remote_backport_branches(remote, pr_number, auth_header):
+    # Returns set of names of backport branches of PR existing in remote repository
+    prefix = "refs/heads/backport/%d-to-" % pr_number
+    output = cmd("git %s ls-remote --heads %s \"%s*\"" % (git_auth(auth_header), remote, prefix))[0]
+    refs = map(lambda x: x.split("\t")[1], filter(None, output.split("\n")))
+    return set(map(lambda x: x[len("refs/heads/"):], filter(lambda x: x.startswith(prefix), refs)))
+
+def get_branch_exists_message(backport_branch, branch):
+    return ("Branch `%s` already exists. It looks like backporting of this PR into branch\n" + \
+        "`%s` had already been performed. To repeat backporting, you'll need to cleanup previous attempt first\n" + \
+        "by deleting branch `%s`. If backport PR had already been created, it will be closed\n" +
+        "automatically when branch is deleted.") % (backport_branch, branch, backport_branch)
+
+def report_backport_error(pr_number, action, branch, message):
+    logging.error("::error::Error occurred while %s into branch %s" % (action.lower(), branch))
+    logging.error(message)
+    notify(pr_number, ("Error occured while %s into branch %s." +
+            "\n\n<details><summary>Error</summary><pre>%s</pre></details>") % (action.lower(), branch, message),
+            branch, "failed")
+
+class ThreadLogBuffer(logging.Filter):
+    """Holds back log records emitted by registered threads, so that they can be
+    replayed later as a single block instead of being mixed with other threads output."""
+
+    def __init__(self):
+        super().__init__()
+        self.buffers = {}
+
+    def filter(self, record):
+        buffer = self.buffers.get(record.thread)
+        if buffer is None:
+            return True
+        buffer.append(record)
+        return False
+
+def backport_in_worktree(branch, pr_data, dry_run, auth_header, log_buffer):
+    log_buffer.buffers[threading.get_ident()] = records = []
+    worktree = tempfile.mkdtemp(prefix="backport-")
+    return_code = 1
+    try:
+        try:
+            with lock_repository_metadata():
+                add_worktree("git", worktree, "origin/%s" % branch)
+        except CommandException as e:
+            action = "Dry run backporting" if dry_run else "Backporting"
+            logging.info("::group::%s PR #%d into branch %s" % (action, pr_data["number"], branch))
+            report_backport_error(pr_data["number"], action, branch, e.message)
+            logging.info("::endgroup::")
+        else:
+            thread_state.cwd = worktree
+            try:
+                return_code = backport(branch, pr_data, dry_run, auth_header)
+            finally:
+                thread_state.cwd = None
+    finally:
+        shutil.rmtree(worktree, ignore_errors=True)
+        del log_buffer.buffers[threading.get_ident()]
+    return (return_code, records)
+
+def backport_parallel(jobs, dry_run, auth_header, parallel):
+    # Backports every job - pair of target branch and PR data - in separate worktree of current repository,
+    # running up to 'parallel' backports at once. Returns list of return codes in the order of jobs.
+    log_buffer = ThreadLogBuffer()
+    logger = logging.getLogger()
+    logger.addFilter(log_buffer)
+    return_codes = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = [executor.submit(backport_in_worktree, branch, pr_data, dry_run, auth_header, log_buffer) \
+                for branch, pr_data in jobs]
+            for future in futures:
+                return_code, records = future.result()
+                # Bypass logger filters, worker thread may already be buffering output of next branch
+                for record in records:
+                    logger.callHandlers(record)
+                return_codes.append(return_code)
+    finally:
+        logger.removeFilter(log_buffer)
+        # Worktree directories are already removed, drop their administrative files
+        with lock_repository_metadata():
+            cmd("git worktree prune")
+    return return_codes
+
 def get_auth_header(url):
     auth_token = base64.b64encode(("x-access-token:%s" % os.environ["GITHUB_TOKEN"]).encode()).decode()
     # GitHub automatically masks GITHUB_TOKEN, but not in base64-encoded form
@@ -181,6 +1346,174 @@ def get_auth_header(url):
     parse_result = urllib.parse.urlparse(url)
     return "http.%s://%s.extraheader=Authorization: basic %s" % (parse_result.scheme, parse_result.hostname, auth_token)
 
+def backport_branches(branches, pr_data, dry_run, auth_header, parallel):
+    if parallel > 1 and len(branches) > 1:
+        return sum(backport_parallel(list(map(lambda x: (x, pr_data), branches)), dry_run, auth_header, parallel))
+    return sum(map(lambda x: backport(x, pr_data, dry_run, auth_header), branches))
+
+def backport_pr(pr_number, branches, url, auth_header, dry_run, matrix):
+    # Backports PR into branches requested by comment, or computes conflict matrix for them
+    run_metrics.ran = True
+    return_code = 0
+    if not matrix:
+        try:
+            if use_graphql():
+                remote_backport_branches[pr_number] = set(get_graphql_pr(pr_number)["backport_branches"])
+            else:
+                remote_backport_branches[pr_number] = get_remote_backport_branches(url, pr_number, auth_header)
+        except CommandException as e:
+            logging.warning("::warning::Failed to list existing backport branches, checking them one by one")
+            logging.warning(e.message)
+        # Fail fast on every branch backported previously, before cloning anything
+        for branch in list(branches):
+            backport_branch = "backport/%d-to-%s" % (pr_number, branch)
+            if backport_branch in remote_backport_branches.get(pr_number, set()):
+                action = "Dry run backporting" if dry_run else "Backporting"
+                logging.info("::group::%s PR #%d into branch %s" % (action, pr_number, branch))
+                message = get_branch_exists_message(backport_branch, branch)
+                backport_pr_url = graphql_pr_data.get(pr_number, {}).get("backport_branches", {}).get(backport_branch)
+                if backport_pr_url is not None:
+                    message += "\nOpen backport PR: %s" % backport_pr_url
+                report_backport_error(pr_number, action, branch, message)
+                logging.info("::endgroup::")
+                branches.remove(branch)
+                return_code += 1
+        if len(branches) == 0:
+            remote_backport_branches.pop(pr_number, None)
+            graphql_pr_data.pop(pr_number, None)
+            return return_code
+    try:
+        pr_data = get_pr(pr_number)
+        with run_metrics.phase("clone"):
+            clone(url, branches, [pr_number], auth_header, pr_data.get("commits"))
+        parallel = int(os.environ.get("BACKPORT_PARALLEL") or "1")
+        if matrix:
+            return_code += conflict_matrix(branches, pr_number, max(parallel, os.cpu_count() or 1))
+        else:
+            return_code += run_with_deferred_requests(lambda: backport_branches(branches, pr_data, dry_run, auth_header, parallel))
+    finally:
+        release_clone()
+        remote_backport_branches.pop(pr_number, None)
+        graphql_pr_data.pop(pr_number, None)
+    return return_code
+
+# Outcomes of backport which are not failures
+SUCCESS_STATUSES = ["success", "dry-run-success", "nothing-to-backport"]
+
+def get_labeled_prs(label):
+    # Returns numbers of merged PRs having label, in ascending order
+    issues = http_paginate("repos/%s/issues?state=closed&labels=%s" % \
+        (os.environ["GITHUB_REPOSITORY"], urllib.parse.quote(label)))
+    return sorted(map(lambda x: x["number"], filter(lambda x: (x.get("pull_request") or {}).get("merged_at"), issues)))
+
+def get_batch_backport_branches(remote, pr_numbers, auth_header):
+    # Returns dict of PR number -> set of names of its backport branches existing in remote repository,
+    # looked up for all PRs with single ls-remote
+    output = cmd("git %s ls-remote --heads %s \"refs/heads/backport/*\"" % (git_auth(auth_header), remote))[0]
+    result = dict(map(lambda x: (x, set()), pr_numbers))
+    for ref in map(lambda x: x.split("\t")[1], filter(None, output.split("\n"))):
+        match = re.match("^refs/heads/(backport/([0-9]+)-to-.+)$", ref)
+        if match is not None and int(match.group(2)) in result:
+            result[int(match.group(2))].add(match.group(1))
+    return result
+
+def backport_batch(url, pr_numbers, branches, dry_run, parallel):
+    # Backports every PR into every branch, sharing single clone. Returns list of results, one per
+    # PR and branch, in the order of PRs.
+    global batch_results
+    run_metrics.ran = True
+    auth_header = get_auth_header(url)
+    batch_results = {}
+    try:
+        try:
+            remote_backport_branches.update(get_batch_backport_branches(url, pr_numbers, auth_header))
+        except CommandException as e:
+            logging.warning("::warning::Failed to list existing backport branches, checking them one by one")
+            logging.warning(e.message)
+        logging.info("Fetching data of %d PRs" % len(pr_numbers))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=API_CONCURRENCY) as executor:
+            futures = list(map(lambda x: executor.submit(get_pr, x), pr_numbers))
+        prs = []
+        for pr_number, future in zip(pr_numbers, futures):
+            try:
+                prs.append(future.result())
+            except CommandException as e:
+                logging.error("::error::Error occurred while fetching PR #%d" % pr_number)
+                logging.error(e.message)
+                for branch in branches:
+                    record_result(pr_number, branch, "failed", e.message)
+        pr_commits = list(map(lambda x: x.get("commits"), prs))
+        with run_metrics.phase("clone"):
+            error = clone(url, branches, list(map(lambda x: x["number"], prs)), auth_header,
+                None if None in pr_commits else max(pr_commits, default=0), False)
+        if error is not None:
+            # Nothing can be backported, failure is only recorded in summary instead of commenting on every PR
+            for pr_data, branch in itertools.product(prs, branches):
+                record_result(pr_data["number"], branch, "failed", error)
+        else:
+            jobs = []
+            for pr_data in prs:
+                jobs += map(lambda x: (x, pr_data), branches)
+            # Every job runs in its own worktree even without parallelism, so that a conflict in one of them
+            # does not leave working tree unusable for the rest
+            run_with_deferred_requests(lambda: sum(backport_parallel(jobs, dry_run, auth_header, parallel)))
+        results = []
+        for pr_number, branch in itertools.product(pr_numbers, branches):
+            result = {
+                "pr": pr_number,
+                "branch": branch,
+                "backport_branch": "backport/%d-to-%s" % (pr_number, branch)
+            }
+            result.update(batch_results.get((pr_number, branch), {"status": "failed", "message": None}))
+            results.append(result)
+        return results
+    finally:
+        batch_results = None
+        release_clone()
+        for pr_number in pr_numbers:
+            remote_backport_branches.pop(pr_number, None)
+            graphql_pr_data.pop(pr_number, None)
+
+def batch_main(args):
+    # Entry point of batch mode, run outside of issue_comment event. Returns number of failed backports.
+    parser = argparse.ArgumentParser(description="Backport many PRs into target branches using single clone")
+    parser.add_argument("--prs", default=os.environ.get("BACKPORT_BATCH_PRS", ""),
+        help="numbers of PRs to backport, separated by commas or spaces")
+    parser.add_argument("--label", default=os.environ.get("BACKPORT_BATCH_LABEL", ""),
+        help="backport all merged PRs having this label")
+    parser.add_argument("--branches", default=os.environ.get("BACKPORT_BATCH_BRANCHES", ""),
+        help="target branches, separated by commas or spaces")
+    parser.add_argument("--dry-run", action="store_true", default=os.environ.get("BACKPORT_BATCH_DRY_RUN") == "true",
+        help="do not push backport branches and create PRs")
+    parser.add_argument("--summary", default=os.environ.get("BACKPORT_BATCH_SUMMARY") or "backport-summary.json",
+        help="path of JSON summary file")
+    parser.add_argument("--url", default="%s/%s.git" % (os.environ.get("GITHUB_SERVER_URL") or "https://github.com",
+        os.environ.get("GITHUB_REPOSITORY")), help="clone URL of repository")
+    options = parser.parse_args(args)
+    # Cloning changes current directory, so that relative path is resolved against the original one
+    summary = os.path.abspath(options.summary)
+    # Sanitize branch names the same way as in comments - leave only chars allowed in branch names
+    branches = list(filter(None, re.split(" +", re.sub("[^0-9a-zA-Z/\\-\\. ]", "", options.branches.replace(",", " ")))))
+    if len(branches) == 0:
+        parser.error("no target branches given")
+    if not re.match("^[0-9, ]*$", options.prs):
+        parser.error("invalid list of PR numbers: %s" % options.prs)
+    pr_numbers = list(map(int, filter(None, re.split("[ ,]+", options.prs))))
+    if options.label:
+        pr_numbers += get_labeled_prs(options.label)
+    pr_numbers = list(dict.fromkeys(pr_numbers))
+    results = []
+    if len(pr_numbers) > 0:
+        results = backport_batch(options.url, pr_numbers, branches, options.dry_run,
+            int(os.environ.get("BACKPORT_PARALLEL") or "1"))
+    else:
+        logging.warning("::warning::No PRs to backport")
+    with open(summary, "w") as f:
+        json.dump({"dry_run": options.dry_run, "prs": pr_numbers, "branches": branches, "results": results}, f, indent=2)
+    failed = len(list(filter(lambda x: x["status"] not in SUCCESS_STATUSES, results)))
+    logging.info("%d of %d backports succeeded. Summary written to %s" % (len(results) - failed, len(results), summary))
+    return failed
+
 def main(event_data):
     dry_run = False
     pr_number = event_data["issue"]["number"]
@@ -189,25 +1522,35 @@ def main(event_data):
     branches = re.split(" +", comment_body)
     if len(branches) > 0 and branches[0] == "/backport":
         branches = branches[1:]
-        if len(branches) > 0 and branches[0] == "--dry-run":
+        matrix = False
+        if len(branches) > 0 and branches[0] in ["--dry-run", "--matrix"]:
             dry_run = True
+            matrix = branches[0] == "--matrix"
             branches = branches[1:]
         if len(branches) == 0:
-            post_comment(pr_number, "<pre>Usage: /backport [--dry-run] &lt;branch1&gt; [&lt;branch2&gt; ...]</pre>")
+            post_comment(pr_number, "<pre>Usage: /backport [--dry-run | --matrix] &lt;branch1&gt; [&lt;branch2&gt; ...]</pre>")
             return 0
         url = event_data["repository"]["clone_url"]
         auth_header = get_auth_header(url)
-        clone(url, branches, pr_number, auth_header)
-        pr_data = get_pr(pr_number)
-        return_code = 0
-        for branch in branches:
-            return_code += backport(branch, pr_data, dry_run, auth_header)
-        return return_code
+        if not matrix and os.environ.get("BACKPORT_STATUS_COMMENT") == "true":
+            return run_with_status_comment(pr_number, branches,
+                lambda: backport_pr(pr_number, branches, url, auth_header, dry_run, matrix))
+        return backport_pr(pr_number, branches, url, auth_header, dry_run, matrix)
     else:
         return 0
 
 if __name__ == "__main__":
-    logging.basicConfig(format="%(message)s", level=logging.INFO)
-    with open(os.environ["GITHUB_EVENT_PATH"]) as f:
-        return_code = main(json.load(f))
+    logging.basicConfig(format="%(message)s", level=logging.DEBUG if os.environ.get("RUNNER_DEBUG") == "1" else logging.INFO)
+    # Cloning changes current directory, so that relative path is resolved against the original one
+    metrics_file = os.environ.get("BACKPORT_METRICS_FILE")
+    if metrics_file:
+        metrics_file = os.path.abspath(metrics_file)
+    try:
+        if len(sys.argv) > 1 or os.environ.get("BACKPORT_BATCH_BRANCHES"):
+            return_code = batch_main(sys.argv[1:])
+        else:
+            with open(os.environ["GITHUB_EVENT_PATH"]) as f:
+                return_code = main(json.load(f))
+    finally:
+        write_metrics(metrics_file)
     sys.exit(return_code)
@@ -24,10 +24,68 @@
 #
 import unittest
 from unittest.mock import patch
+import asyncio
+import contextlib
+import http.server
+import json
 import logging
 import tempfile
+import threading
+import time
+import re
 import os
+import functools
+import hashlib
+import hmac
+import fcntl
+import requests
+import socket
+import subprocess
+import sys
 import backport_command
+import backport_server
+from backport_stub_api import StubGitHubApi
+
+class StubGitHttpServer:
+    """Local smart HTTP git server serving bare repositories of a directory with git http-backend,
+    recording Authorization headers of every request."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def handle_request(self):
+            self.server.stub.authorizations.append(self.headers.get_all("Authorization", []))
+            length = int(self.headers.get("Content-Length", 0))
+            path, _, query = self.path.partition("?")
+            env = dict(os.environ, GIT_PROJECT_ROOT=self.server.stub.root, GIT_HTTP_EXPORT_ALL="1", REMOTE_USER="test",
+                REMOTE_ADDR="127.0.0.1", PATH_INFO=path, QUERY_STRING=query, REQUEST_METHOD=self.command,
+                CONTENT_TYPE=self.headers.get("Content-Type", ""), CONTENT_LENGTH=str(length),
+                HTTP_CONTENT_ENCODING=self.headers.get("Content-Encoding", ""), GIT_PROTOCOL=self.headers.get("Git-Protocol", ""))
+            result = subprocess.run(["git", "http-backend"], input=self.rfile.read(length), env=env, capture_output=True)
+            header, _, content = result.stdout.partition(b"\r\n\r\n")
+            headers = dict(map(lambda x: x.split(": ", 1), header.decode().split("\r\n")))
+            self.send_response(int(headers.pop("Status", "200").split()[0]))
+            for name in headers:
+                self.send_header(name, headers[name])
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = handle_request
+        do_POST = handle_request
+
+        def log_message(self, format, *args):
+            pass
+
+    def __init__(self, root):
+        self.root = root
+        self.authorizations = []
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.Handler)
+        self.server.stub = self
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
 
 class BackportCommandTest(unittest.TestCase):
 
@@ -80,10 +138,11 @@ class BackportCommandTest(unittest.TestCase):
         self.assertEqual(result, 0)
         post_comment.assert_called_once_with(1, self.AnyStringWith("Usage: "))
 
+    @patch("backport_command.get_remote_backport_branches", return_value=set())
     @patch("backport_command.get_pr")
     @patch("backport_command.clone")
     @patch("backport_command.backport")
-    def testParseDryRun(self, backport, clone, get_pr):
+    def testParseDryRun(self, backport, clone, get_pr, get_remote_backport_branches):
         event_data = {
             "issue": {
                 "number": 1
@@ -101,10 +160,11 @@ class BackportCommandTest(unittest.TestCase):
         self.assertEqual(result, 0)
         backport.assert_called_once_with("feature/backport-target", unittest.mock.ANY, True, auth_header)
 
+    @patch("backport_command.get_remote_backport_branches", return_value=set())
     @patch("backport_command.get_pr")
     @patch("backport_command.clone")
     @patch("backport_command.backport")
-    def testParseWithSanitization(self, backport, clone, get_pr):
+    def testParseWithSanitization(self, backport, clone, get_pr, get_remote_backport_branches):
         event_data = {
             "issue": {
                 "number": 1
@@ -241,6 +301,1125 @@ class BackportCommandTest(unittest.TestCase):
         self.assertIn("Merge branch 'main' into feature/backport-target", result)
         backport_command.cmd("rm -rf %s" % tempdir)
 
+    def startStubApi(self, variables = {}):
+        stub = StubGitHubApi()
+        self.addCleanup(stub.stop)
+        # Any other environment variables of test are set here too, so that they are restored by the same patch
+        env = patch.dict(os.environ, dict(variables, GITHUB_API_URL=stub.url, GITHUB_REPOSITORY="Cray-HPE/test", GITHUB_TOKEN="token"))
+        env.start()
+        self.addCleanup(env.stop)
+        # Drop pooled connections to servers stopped by previous tests
+        backport_command.http_session = None
+        return stub
+
+    @patch("time.sleep")
+    @patch("backport_command.rate_limit_hit", new_callable=threading.Event)
+    def testHttpRetryRateLimit(self, rate_limit_hit, sleep):
+        stub = self.startStubApi()
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 429, {"message": "Slow down"}, {"Retry-After": "7"})
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 403, {"message": "API rate limit exceeded"},
+            {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "0"})
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 502, {"message": "Bad Gateway"})
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 200, {"number": 1})
+        result = backport_command.get_pr(1)
+        self.assertEqual(result, {"number": 1})
+        self.assertEqual(len(stub.requests), 4)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [7, 0, backport_command.HTTP_BACKOFF * 4])
+        self.assertTrue(rate_limit_hit.is_set())
+        # All requests should reuse single keep-alive connection
+        self.assertEqual(len(set(request[2] for request in stub.requests)), 1)
+
+    @patch("time.sleep")
+    def testHttpNoRetry(self, sleep):
+        stub = self.startStubApi()
+        stub.add("POST", "/repos/Cray-HPE/test/issues/1/comments", 502, {"message": "Bad Gateway"})
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 403, {"message": "Forbidden"})
+        with self.assertRaises(backport_command.CommandException):
+            backport_command.post_comment(1, "Test")
+        with self.assertRaises(backport_command.CommandException):
+            backport_command.get_pr(1)
+        self.assertEqual(len(stub.requests), 2)
+        sleep.assert_not_called()
+
+    @patch("time.sleep")
+    @patch("backport_command.HTTP_TIMEOUT", (1, 0.2))
+    def testHttpTimeout(self, sleep):
+        # Server accepting connections but never responding
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(16)
+        self.addCleanup(server.close)
+        url = "http://127.0.0.1:%d" % server.getsockname()[1]
+        backport_command.http_session = None
+        with patch.dict(os.environ, {"GITHUB_API_URL": url, "GITHUB_REPOSITORY": "Cray-HPE/test", "GITHUB_TOKEN": "token"}):
+            with self.assertRaises(backport_command.CommandException):
+                backport_command.get_pr(1)
+            self.assertEqual(sleep.call_count, backport_command.HTTP_RETRIES)
+            # POST is not repeated, as it might have been processed
+            sleep.reset_mock()
+            with self.assertRaises(backport_command.CommandException):
+                backport_command.post_comment(1, "Test")
+            sleep.assert_not_called()
+
+    def testPrCommitsPagination(self):
+        stub = self.startStubApi()
+        path = "/repos/Cray-HPE/test/pulls/1/commits?per_page=100"
+        stub.add("GET", path, 200, [{"sha": "a"}, {"sha": "b"}], {"Link": '<%s%s&page=2>; rel="next", <%s%s&page=2>; rel="last"' % (stub.url, path, stub.url, path)})
+        stub.add("GET", path + "&page=2", 200, [{"sha": "c"}], {"Link": '<%s%s&page=1>; rel="prev"' % (stub.url, path)})
+        commits = backport_command.get_pr_commits(1)
+        self.assertEqual(next(commits), "a")
+        # Second page should not be requested until first one is consumed
+        self.assertEqual(len(stub.requests), 1)
+        self.assertEqual(list(commits), ["b", "c"])
+        self.assertEqual([request[1] for request in stub.requests], [path, path + "&page=2"])
+
+    @patch("backport_command.get_remote_backport_branches", return_value=set())
+    @patch.dict(os.environ, {"BACKPORT_PARALLEL": "2"})
+    @patch("backport_command.post_comment_async")
+    @patch("backport_command.create_pr_async")
+    @patch("backport_command.get_pr_commits")
+    @patch("backport_command.get_pr")
+    @patch("backport_command.clone")
+    def testParallelBackport(self, clone, get_pr, get_pr_commits, create_pr_async, post_comment_async, get_remote_backport_branches):
+        tempdir = tempfile.mkdtemp()
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git branch release/1.0")
+        backport_command.cmd("git branch release/1.1")
+        self.addFile("file2")
+        backport_command.cmd("git remote add origin ./.git")
+        backport_command.cmd("git fetch --all")
+        get_pr_commits.return_value = [backport_command.cmd("git log -1 --format='%H'")[0]]
+        get_pr.return_value = {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/backport-command-action/pull/1"
+                }
+            }
+        }
+        create_pr_async.return_value = {"number": 2, "html_url": "https://github.com/Cray-HPE/backport-command-action/pull/2"}
+        event_data = {
+            "issue": {
+                "number": 1
+            },
+            "comment": {
+                "body": "/backport release/1.0 release/1.1 release/missing"
+            },
+            "repository": {
+                "clone_url": "https://github.com/Cray-HPE/backport-command-action.git"
+            }
+        }
+        # Pushes of parallel backports don't hold repository lock, so they don't wait for each other
+        pushes = []
+        locked = set()
+        cmd = backport_command.cmd
+        lock_repository_metadata = backport_command.lock_repository_metadata
+        def cmd_spy(command, input = None):
+            if " push " in command:
+                pushes.append(threading.get_ident() in locked)
+            return cmd(command, input)
+        @contextlib.contextmanager
+        def lock_spy():
+            with lock_repository_metadata():
+                locked.add(threading.get_ident())
+                try:
+                    yield
+                finally:
+                    locked.remove(threading.get_ident())
+        with self.assertLogs(level=logging.INFO) as logs, patch("backport_command.cmd", side_effect=cmd_spy), \
+                patch("backport_command.lock_repository_metadata", lock_spy):
+            result = backport_command.main(event_data)
+        self.assertEqual(result, 1)
+        self.assertEqual(pushes, [False, False])
+        # Output of every backport should form single group
+        groups = [line for line in logs.output if "::group::" in line or "::endgroup::" in line]
+        self.assertEqual(len(groups), 8)
+        for i in range(0, len(groups), 2):
+            self.assertIn("::group::", groups[i])
+            self.assertIn("::endgroup::", groups[i + 1])
+        self.assertIn("release/1.0", groups[0])
+        self.assertIn("release/missing", groups[4])
+        self.assertIn("Publishing results", groups[6])
+        for branch in ["release/1.0", "release/1.1"]:
+            result = backport_command.cmd("git log --format='%%s' origin/backport/1-to-%s" % branch)[0].split("\n")
+            self.assertEqual(result[0], "Add file2")
+            self.assertEqual(backport_command.cmd("git rev-parse --abbrev-ref backport/1-to-%s@{upstream}" % branch)[0],
+                "origin/backport/1-to-%s" % branch)
+        self.assertEqual(backport_command.cmd("git worktree list")[0].count("\n"), 0)
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def createOriginRepo(self, tempdir):
+        # Bare repo resembling GitHub: main and release/1.0 branches, PR #1 head stored in refs/pull/1/head
+        origin = os.path.join(tempdir, "origin.git")
+        backport_command.cmd("git init -q --bare --initial-branch=main %s" % origin)
+        backport_command.cmd("git -C %s config uploadpack.allowFilter true" % origin)
+        work = os.path.join(tempdir, "work")
+        backport_command.cmd("git init -q --initial-branch=main %s" % work)
+        os.chdir(work)
+        self.addFile("file1")
+        backport_command.cmd("git branch release/1.0")
+        backport_command.cmd("git checkout -q -b feature")
+        self.addFile("file2")
+        backport_command.cmd("git push -q %s main release/1.0 feature:refs/pull/1/head" % origin)
+        os.chdir(tempdir)
+        return "file://%s" % origin
+
+    @patch.dict(os.environ, {"BACKPORT_PARTIAL_CLONE": "true", "GITHUB_REPOSITORY": "Cray-HPE/test"})
+    @patch("backport_command.post_comment")
+    @patch("backport_command.create_pr")
+    @patch("backport_command.get_pr_commits")
+    def testPartialClone(self, get_pr_commits, create_pr, post_comment):
+        tempdir = tempfile.mkdtemp()
+        url = self.createOriginRepo(tempdir)
+        auth_header = backport_command.get_auth_header(url)
+        backport_command.clone(url, ["release/1.0"], [1], auth_header)
+        post_comment.assert_not_called()
+        self.assertEqual(os.getcwd(), os.path.join(tempdir, "test"))
+        # Nothing is checked out and no file contents are fetched
+        self.assertEqual(os.listdir("."), [".git"])
+        self.assertEqual(backport_command.cmd("git rev-list --objects --missing=print --all | grep -c '^?'")[0], "2")
+        commit_hash = backport_command.cmd("git rev-parse refs/pull/1/head")[0]
+        get_pr_commits.return_value = [commit_hash]
+        pr_data = {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/backport-command-action/pull/1"
+                }
+            }
+        }
+        result = backport_command.backport("release/1.0", pr_data, False, auth_header)
+        self.assertEqual(result, 0)
+        result = backport_command.cmd("git -C %s/origin.git log --format='%%s' backport/1-to-release/1.0" % tempdir)[0].split("\n")
+        self.assertEqual(result, ["Add file2", "Add file1"])
+        self.assertIn("file2", os.listdir("."))
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch.dict(os.environ, {"BACKPORT_PARTIAL_CLONE": "true", "GITHUB_REPOSITORY": "Cray-HPE/test", "BACKPORT_HISTORY_DEPTH": "2"})
+    @patch("backport_command.post_comment")
+    @patch("backport_command.get_pr_commits")
+    def testPartialCloneDepth(self, get_pr_commits, post_comment):
+        tempdir = tempfile.mkdtemp()
+        url = self.createOriginRepo(tempdir)
+        os.chdir(os.path.join(tempdir, "work"))
+        backport_command.cmd("git checkout -q release/1.0")
+        for i in range(3, 6):
+            self.addFile("file%d" % i)
+        backport_command.cmd("git push -q %s/origin.git release/1.0" % tempdir)
+        os.chdir(tempdir)
+        auth_header = backport_command.get_auth_header(url)
+        backport_command.clone(url, ["release/1.0"], [1], auth_header, 1)
+        # History of target branch is bounded by history depth, PR commit is fetched with its parent
+        self.assertEqual(backport_command.cmd("git rev-list --count origin/release/1.0")[0], "2")
+        self.assertEqual(backport_command.cmd("git rev-list --count refs/pull/1/head")[0], "2")
+        # File contents needed by patch ids of branch history are downloaded with single request
+        missing = "git rev-list --objects --missing=print origin/release/1.0 | grep -c '^?'"
+        self.assertEqual(backport_command.cmd(missing)[0], "4")
+        with patch("backport_command.cmd", wraps=backport_command.cmd) as cmd_spy:
+            patch_ids = backport_command.get_branch_patch_ids("release/1.0")
+        self.assertEqual(len(patch_ids), 1)
+        self.assertEqual(len(list(filter(lambda x: " fetch " in x.args[0], cmd_spy.call_args_list))), 1)
+        self.assertEqual(backport_command.cmd(missing)[0], "3")
+        get_pr_commits.return_value = [backport_command.cmd("git rev-parse refs/pull/1/head")[0]]
+        pr_data = {"number": 1, "title": "Test PR #1", "_links": {"html": {"href": "https://github.com/Cray-HPE/test/pull/1"}}}
+        self.assertEqual(backport_command.backport("release/1.0", pr_data, True, auth_header), 0)
+        self.assertEqual(backport_command.cmd("git show --format='' --name-only HEAD")[0], "file2")
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def backportFromHttpRemote(self, get_pr_commits, cache = False):
+        # Backports PR #1 from origin served over HTTP, checking that git sends a single Authorization header
+        tempdir = tempfile.mkdtemp()
+        if cache:
+            os.environ["BACKPORT_CACHE_DIR"] = os.path.join(tempdir, "cache")
+        self.createOriginRepo(tempdir)
+        server = StubGitHttpServer(tempdir)
+        url = "%s/origin.git" % server.url
+        auth_header = "http.%s/.extraheader=Authorization: basic dGVzdA==" % server.url
+        try:
+            backport_command.clone(url, ["release/1.0"], [1], auth_header)
+            get_pr_commits.return_value = [backport_command.cmd("git rev-parse refs/pull/1/head")[0]]
+            pr_data = {
+                "number": 1,
+                "title": "Test PR #1",
+                "_links": {
+                    "html": {
+                        "href": "https://github.com/Cray-HPE/backport-command-action/pull/1"
+                    }
+                }
+            }
+            self.assertEqual(backport_command.backport("release/1.0", pr_data, False, auth_header), 0)
+            backport_command.release_clone()
+        finally:
+            server.stop()
+        self.assertEqual(backport_command.cmd("git -C %s/origin.git log --format='%%s' backport/1-to-release/1.0" % tempdir)[0],
+            "Add file2\nAdd file1")
+        self.assertNotEqual(server.authorizations, [])
+        for authorization in server.authorizations:
+            self.assertEqual(authorization, ["basic dGVzdA=="])
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch.dict(os.environ, {"BACKPORT_PARTIAL_CLONE": "true", "GITHUB_REPOSITORY": "Cray-HPE/test"})
+    @patch("backport_command.post_comment")
+    @patch("backport_command.create_pr")
+    @patch("backport_command.get_pr_commits")
+    def testPartialCloneHttpAuth(self, get_pr_commits, create_pr, post_comment):
+        self.backportFromHttpRemote(get_pr_commits)
+        post_comment.assert_called_once()
+
+    @patch.dict(os.environ, {"BACKPORT_PARTIAL_CLONE": "true", "GITHUB_REPOSITORY": "Cray-HPE/test"})
+    @patch("backport_command.post_comment")
+    @patch("backport_command.create_pr")
+    @patch("backport_command.get_pr_commits")
+    def testMirrorCacheHttpAuth(self, get_pr_commits, create_pr, post_comment):
+        self.backportFromHttpRemote(get_pr_commits, True)
+        post_comment.assert_called_once()
+
+    @patch.dict(os.environ, {"GITHUB_REPOSITORY": "Cray-HPE/test"})
+    @patch("backport_command.post_comment")
+    @patch("backport_command.get_pr_commits")
+    def testMirrorCacheLock(self, get_pr_commits, post_comment):
+        tempdir = tempfile.mkdtemp()
+        url = self.createOriginRepo(tempdir)
+        os.environ["BACKPORT_CACHE_DIR"] = os.path.join(tempdir, "cache")
+        auth_header = backport_command.get_auth_header(url)
+        backport_command.clone(url, ["release/1.0"], [1], auth_header)
+        get_pr_commits.return_value = [backport_command.cmd("git rev-parse refs/pull/1/head")[0]]
+        pr_data = {"number": 1, "title": "Test PR #1", "_links": {"html": {"href": "https://github.com/Cray-HPE/test/pull/1"}}}
+        # Worktree of the mirror is not added while other process holds the mirror lock
+        results = []
+        with open(os.path.join(tempdir, "cache", "Cray-HPE", "test.git.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            thread = threading.Thread(target=lambda: results.append(backport_command.backport_parallel(
+                [("release/1.0", pr_data)], True, auth_header, 2)))
+            thread.start()
+            time.sleep(0.5)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(backport_command.cmd("git worktree list")[0].count("\n"), 1)
+        thread.join(30)
+        self.assertEqual(results, [[0]])
+        post_comment.assert_called_once_with(1, "Dry run backporting into branch release/1.0 was successful.")
+        backport_command.release_clone()
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch.dict(os.environ, {"GITHUB_REPOSITORY": "Cray-HPE/test", "BACKPORT_CACHE_SIZE": "0"})
+    @patch("backport_command.post_comment")
+    @patch("backport_command.create_pr")
+    @patch("backport_command.get_pr_commits")
+    def testMirrorCache(self, get_pr_commits, create_pr, post_comment):
+        tempdir = tempfile.mkdtemp()
+        url = self.createOriginRepo(tempdir)
+        cache_dir = os.path.join(tempdir, "cache")
+        os.environ["BACKPORT_CACHE_DIR"] = cache_dir
+        # Unused mirror of other repository should be pruned once cache exceeds size limit
+        os.makedirs(os.path.join(cache_dir, "Cray-HPE", "other.git"))
+        auth_header = backport_command.get_auth_header(url)
+        pr_data = {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/backport-command-action/pull/1"
+                }
+            }
+        }
+        mirror = os.path.join(cache_dir, "Cray-HPE", "test.git")
+        for i in range(2):
+            post_comment.reset_mock()
+            backport_command.clone(url, ["release/1.0"], [1], auth_header)
+            post_comment.assert_not_called()
+            self.assertEqual(os.getcwd(), os.path.join(tempdir, "test"))
+            self.assertEqual(backport_command.cmd("git rev-parse --git-common-dir")[0], mirror)
+            get_pr_commits.return_value = [backport_command.cmd("git rev-parse refs/pull/1/head")[0]]
+            self.assertEqual(backport_command.backport("release/1.0", pr_data, True, auth_header), 0)
+            backport_command.release_clone()
+            self.assertFalse(os.path.exists(os.path.join(tempdir, "test")))
+            self.assertEqual(backport_command.cmd("git -C %s worktree list" % mirror)[0].count("\n"), 0)
+            self.assertEqual(backport_command.cmd("git -C %s branch" % mirror)[0], "")
+        self.assertEqual(os.listdir(os.path.join(cache_dir, "Cray-HPE")).count("other.git"), 0)
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch.dict(os.environ, {"BACKPORT_ENGINE": "merge-tree"})
+    @patch("backport_command.post_comment")
+    @patch("backport_command.create_pr")
+    @patch("backport_command.get_pr_commits")
+    def testMergeTreeEngine(self, get_pr_commits, create_pr, post_comment):
+        tempdir = tempfile.mkdtemp()
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git branch feature/backport-target")
+        self.addFile("file2")
+        backport_command.cmd("echo 'Changed' >> file1 && git commit -a --author='Jane Doe <jane@example.com>' " +
+            "-m 'Change file1' -m 'Signed-off-by: Jane Doe <jane@example.com>'")
+        backport_command.cmd("git remote add origin ./.git")
+        backport_command.cmd("git fetch --all")
+        get_pr_commits.return_value = backport_command.cmd("git rev-list --reverse HEAD~2..HEAD")[0].split("\n")
+        pr_data = {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/backport-command-action/pull/1"
+                }
+            }
+        }
+        auth_header = backport_command.get_auth_header("https://github.com/Cray-HPE/backport-command-action.git")
+        result = backport_command.backport("feature/backport-target", pr_data, False, auth_header)
+        self.assertEqual(result, 0)
+        # Working tree is not touched
+        self.assertEqual(backport_command.cmd("git rev-parse --abbrev-ref HEAD")[0], "main")
+        self.assertEqual(backport_command.cmd("git status --porcelain")[0], "")
+        # Result should be the same as produced by git cherry-pick -x
+        backport_command.cmd("git checkout -b expected origin/feature/backport-target")
+        for commit in get_pr_commits.return_value:
+            backport_command.cmd("git cherry-pick -x %s" % commit)
+        log_format = "git log --format='%%T%%n%%an <%%ae> %%ad%%n%%B' origin/feature/backport-target..%s"
+        self.assertEqual(backport_command.cmd(log_format % "origin/backport/1-to-feature/backport-target")[0],
+            backport_command.cmd(log_format % "expected")[0])
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch.dict(os.environ, {"BACKPORT_ENGINE": "merge-tree"})
+    @patch("backport_command.post_comment")
+    @patch("backport_command.create_pr")
+    @patch("backport_command.get_pr_commits")
+    def testMergeTreeEngineConflict(self, get_pr_commits, create_pr, post_comment):
+        tempdir = tempfile.mkdtemp()
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git checkout -b feature/backport-target")
+        backport_command.cmd("echo 'Target change' > file1 && git commit -am 'Change file1 on target'")
+        backport_command.cmd("git checkout main")
+        self.addFile("file2")
+        backport_command.cmd("echo 'PR change' > file1 && git commit -am 'Change file1 in PR'")
+        backport_command.cmd("git remote add origin ./.git")
+        backport_command.cmd("git fetch --all")
+        get_pr_commits.return_value = iter(backport_command.cmd("git rev-list --reverse HEAD~2..HEAD")[0].split("\n"))
+        pr_data = {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/backport-command-action/pull/1"
+                }
+            }
+        }
+        auth_header = backport_command.get_auth_header("https://github.com/Cray-HPE/backport-command-action.git")
+        result = backport_command.backport("feature/backport-target", pr_data, True, auth_header)
+        self.assertEqual(result, 1)
+        # Conflict is reported by cherry-pick in working tree, after first commit was applied
+        result = backport_command.cmd("git status")[0].split("\n")
+        self.assertIn("On branch backport/1-to-feature/backport-target", result)
+        self.assertIn("Unmerged paths:", result)
+        self.assertIn("Add file2", backport_command.cmd("git log -1 --format='%s'")[0])
+        post_comment.assert_called_once_with(1, self.AnyStringWith("CONFLICT (content): Merge conflict in file1"))
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch("backport_command.post_comment")
+    @patch("backport_command.get_pr_commits")
+    @patch("backport_command.get_pr")
+    @patch("backport_command.clone")
+    def testConflictMatrix(self, clone, get_pr, get_pr_commits, post_comment):
+        tempdir = tempfile.mkdtemp()
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git branch release/1.0")
+        backport_command.cmd("git checkout -b release/1.1")
+        backport_command.cmd("echo 'Target change' > file1 && git commit -am 'Change file1 on target'")
+        backport_command.cmd("git checkout main")
+        self.addFile("file2")
+        backport_command.cmd("echo 'PR change' > file1 && git commit -am 'Change file1 in PR'")
+        backport_command.cmd("git remote add origin ./.git")
+        backport_command.cmd("git fetch --all")
+        commits = backport_command.cmd("git rev-list --reverse HEAD~2..HEAD")[0].split("\n")
+        get_pr_commits.return_value = iter(commits)
+        event_data = {
+            "issue": {
+                "number": 1
+            },
+            "comment": {
+                "body": "/backport --matrix release/1.0 release/1.1 release/missing"
+            },
+            "repository": {
+                "clone_url": "https://github.com/Cray-HPE/backport-command-action.git"
+            }
+        }
+        result = backport_command.main(event_data)
+        self.assertEqual(result, 2)
+        post_comment.assert_called_once()
+        lines = post_comment.call_args.args[1].split("\n")
+        self.assertEqual(lines[2], "| Commit | `release/1.0` | `release/1.1` | `release/missing` |")
+        self.assertEqual(lines[4], "| %s Add file2 | :white_check_mark: | :white_check_mark: | :warning: error |" % commits[0][:7])
+        self.assertEqual(lines[5], "| %s Change file1 in PR | :white_check_mark: | :x: `file1` | :warning: error |" % commits[1][:7])
+        self.assertIn("Error for branch release/missing", lines[7])
+        # Working tree is not touched
+        self.assertEqual(backport_command.cmd("git rev-parse --abbrev-ref HEAD")[0], "main")
+        self.assertEqual(backport_command.cmd("git status --porcelain")[0], "")
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch("backport_command.post_comment")
+    @patch("backport_command.create_pr")
+    @patch("backport_command.get_pr_commits")
+    def testSkipAppliedCommits(self, get_pr_commits, create_pr, post_comment):
+        tempdir = tempfile.mkdtemp()
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git branch release/1.0")
+        backport_command.cmd("git branch release/1.1")
+        self.addFile("file2")
+        self.addFile("file3")
+        commits = backport_command.cmd("git rev-list --reverse HEAD~2..HEAD")[0].split("\n")
+        # Changes of first PR commit were already backported manually, on release/1.1 both were
+        backport_command.cmd("git checkout release/1.0 && git cherry-pick %s" % commits[0])
+        backport_command.cmd("git checkout release/1.1 && git cherry-pick %s %s" % tuple(commits))
+        backport_command.cmd("git checkout main")
+        backport_command.cmd("git remote add origin ./.git")
+        backport_command.cmd("git fetch --all")
+        get_pr_commits.side_effect = lambda x: iter(commits)
+        pr_data = {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/backport-command-action/pull/1"
+                }
+            }
+        }
+        auth_header = backport_command.get_auth_header("https://github.com/Cray-HPE/backport-command-action.git")
+        result = backport_command.backport("release/1.0", pr_data, True, auth_header)
+        self.assertEqual(result, 0)
+        post_comment.assert_called_once_with(1, "Dry run backporting into branch release/1.0 was successful." +
+            "\n\nSkipped commits already present in branch release/1.0: %s" % commits[0])
+        result = backport_command.cmd("git log --format='%s' origin/release/1.0..HEAD")[0].split("\n")
+        self.assertEqual(result, ["Add file3"])
+        post_comment.reset_mock()
+        result = backport_command.backport("release/1.1", pr_data, False, auth_header)
+        self.assertEqual(result, 0)
+        create_pr.assert_not_called()
+        post_comment.assert_called_once_with(1, self.AnyStringWith("All changes of this PR are already present in branch release/1.1"))
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def testShallowBranchPatchIds(self):
+        tempdir = tempfile.mkdtemp()
+        work = os.path.join(tempdir, "work")
+        backport_command.cmd("git init -q --initial-branch=main %s" % work)
+        os.chdir(work)
+        for i in range(4):
+            self.addFile("file%d" % i)
+        backport_command.cmd("git clone -q --depth=2 file://%s %s/shallow" % (work, tempdir))
+        os.chdir(os.path.join(tempdir, "shallow"))
+        # Boundary commit of shallow clone would be diffed as adding all files
+        patch_ids = backport_command.get_branch_patch_ids("main")
+        self.assertEqual(patch_ids, set(backport_command.parse_patch_ids(
+            backport_command.cmd("git show HEAD | git patch-id --stable")[0]).values()))
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch.dict(os.environ, {"GITHUB_REPOSITORY": "Cray-HPE/test", "BACKPORT_HISTORY_DEPTH": "0"})
+    @patch("backport_command.post_comment")
+    def testHistoryDepthZero(self, post_comment):
+        tempdir = tempfile.mkdtemp()
+        url = self.createOriginRepo(tempdir)
+        backport_command.clone(url, ["release/1.0"], [1], backport_command.get_auth_header(url))
+        post_comment.assert_not_called()
+        self.assertEqual(backport_command.cmd("git rev-list --count origin/release/1.0")[0], "1")
+        # Lookup of changes already present in target branch is disabled
+        with patch("backport_command.cmd", wraps=backport_command.cmd) as cmd_spy:
+            self.assertEqual(backport_command.get_branch_patch_ids("release/1.0"), set())
+        cmd_spy.assert_not_called()
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch("backport_command.post_comment")
+    @patch("backport_command.get_pr")
+    @patch("backport_command.clone")
+    @patch("backport_command.backport")
+    def testExistingBackportBranch(self, backport, clone, get_pr, post_comment):
+        tempdir = tempfile.mkdtemp()
+        url = self.createOriginRepo(tempdir)
+        backport_command.cmd("git -C %s/work push -q %s release/1.0:backport/1-to-release/1.0 main:backport/10-to-main" % (tempdir, url))
+        event_data = {
+            "issue": {
+                "number": 1
+            },
+            "comment": {
+                "body": "/backport release/1.0 main"
+            },
+            "repository": {
+                "clone_url": url
+            }
+        }
+        backport.return_value = 0
+        result = backport_command.main(event_data)
+        self.assertEqual(result, 1)
+        post_comment.assert_called_once_with(1, self.AnyStringWith("Branch `backport/1-to-release/1.0` already exists."))
+        clone.assert_called_once_with(url, ["main"], [1], unittest.mock.ANY, unittest.mock.ANY)
+        backport.assert_called_once_with("main", unittest.mock.ANY, False, unittest.mock.ANY)
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch("backport_command.API_WRITE_INTERVAL", 0.2)
+    @patch("backport_command.get_remote_backport_branches", return_value=set())
+    @patch("backport_command.get_pr_commits")
+    @patch("backport_command.clone")
+    def testDeferredRequests(self, clone, get_pr_commits, get_remote_backport_branches):
+        stub = self.startStubApi()
+        tempdir = tempfile.mkdtemp()
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git branch release/1.0")
+        backport_command.cmd("git branch release/1.1")
+        self.addFile("file2")
+        backport_command.cmd("git remote add origin ./.git")
+        backport_command.cmd("git fetch --all")
+        get_pr_commits.side_effect = lambda x: iter([backport_command.cmd("git log -1 --format='%H' main")[0]])
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 200, {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/test/pull/1"
+                }
+            }
+        })
+        stub.add("POST", "/repos/Cray-HPE/test/pulls", 201, {"number": 2, "html_url": "https://github.com/Cray-HPE/test/pull/2"})
+        stub.add("POST", "/repos/Cray-HPE/test/issues/1/comments", 201, {"id": 1})
+        event_data = {
+            "issue": {
+                "number": 1
+            },
+            "comment": {
+                "body": "/backport release/1.0 release/1.1"
+            },
+            "repository": {
+                "clone_url": "https://github.com/Cray-HPE/test.git"
+            }
+        }
+        result = backport_command.main(event_data)
+        self.assertEqual(result, 0)
+        writes = list(filter(lambda x: x[0] == "POST", stub.requests))
+        self.assertEqual(sorted(map(lambda x: json.loads(x[4]).get("base"), writes[:2])), ["release/1.0", "release/1.1"])
+        self.assertEqual(len(writes), 4)
+        self.assertIn("Backporting into branch release/1.0 was successful", "".join(map(lambda x: x[4], writes)))
+        self.assertIn("Backporting into branch release/1.1 was successful", "".join(map(lambda x: x[4], writes)))
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch("backport_command.STATUS_DEBOUNCE", 60)
+    @patch("backport_command.API_WRITE_INTERVAL", 0)
+    @patch("backport_command.get_remote_backport_branches", return_value=set())
+    @patch("backport_command.get_pr_commits")
+    @patch("backport_command.clone")
+    def testStatusComment(self, clone, get_pr_commits, get_remote_backport_branches):
+        stub = self.startStubApi({"BACKPORT_STATUS_COMMENT": "true"})
+        tempdir = tempfile.mkdtemp()
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git branch release/1.0")
+        backport_command.cmd("git branch release/1.1")
+        self.addFile("file2")
+        backport_command.cmd("git remote add origin ./.git")
+        backport_command.cmd("git fetch --all")
+        get_pr_commits.side_effect = lambda x: iter([backport_command.cmd("git log -1 --format='%H' main")[0]])
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 200, {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/test/pull/1"
+                }
+            }
+        })
+        stub.add("POST", "/repos/Cray-HPE/test/pulls", 201, {"number": 2, "html_url": "https://github.com/Cray-HPE/test/pull/2"})
+        stub.add("POST", "/repos/Cray-HPE/test/issues/1/comments", 201, {"id": 10})
+        stub.add("PATCH", "/repos/Cray-HPE/test/issues/comments/10", 200, {"id": 10})
+        event_data = {
+            "issue": {
+                "number": 1
+            },
+            "comment": {
+                "body": "/backport release/1.0 release/1.1"
+            },
+            "repository": {
+                "clone_url": "https://github.com/Cray-HPE/test.git"
+            }
+        }
+        result = backport_command.main(event_data)
+        self.assertEqual(result, 0)
+        self.assertIsNone(backport_command.status_comment)
+        comments = list(filter(lambda x: x[1].startswith("/repos/Cray-HPE/test/issues/"), stub.requests))
+        # Status comment is created once, then all updates are coalesced into single edit
+        self.assertEqual(list(map(lambda x: x[0], comments)), ["POST", "PATCH"])
+        self.assertIn("| `release/1.0` | :hourglass: Pending |", json.loads(comments[0][4])["body"])
+        body = json.loads(comments[1][4])["body"]
+        self.assertIn("| `release/1.0` | :white_check_mark: Successful |", body)
+        self.assertIn("| `release/1.1` | :white_check_mark: Successful |", body)
+        self.assertIn("Backporting into branch release/1.1 was successful. New PR: https://github.com/Cray-HPE/test/pull/2", body)
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch("backport_command.get_remote_backport_branches")
+    @patch("backport_command.clone")
+    def testGraphQL(self, clone, get_remote_backport_branches):
+        stub = self.startStubApi({"BACKPORT_GRAPHQL": "true"})
+        tempdir = tempfile.mkdtemp()
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git branch release/1.0")
+        backport_command.cmd("git branch release/1.1")
+        backport_command.cmd("git checkout -b feature")
+        self.addFile("file2")
+        backport_command.cmd("git checkout main")
+        self.addFile("file3")
+        backport_command.cmd("git merge --no-ff feature")
+        backport_command.cmd("git remote add origin ./.git")
+        backport_command.cmd("git fetch --all")
+        feature_commit = backport_command.cmd("git log -1 --format='%H' feature")[0]
+        merge_commit = backport_command.cmd("git log -1 --format='%H' main")[0]
+        commit_node = lambda sha, parents, subject: {"commit": {
+            "oid": sha,
+            "messageHeadline": subject,
+            "parents": {"totalCount": parents},
+            "author": {"name": "PR Author", "email": "author@example.com", "date": "2021-11-02T10:00:00+01:00"}
+        }}
+        pull_request = {"number": 1, "title": "Test PR #1", "url": "https://github.com/Cray-HPE/test/pull/1", "headRefName": "feature"}
+        stub.add("POST", "/graphql", 200, {"data": {"repository": {
+            "pullRequest": dict(pull_request, commits={
+                "pageInfo": {"hasNextPage": True, "endCursor": "cursor1"},
+                "nodes": [commit_node(feature_commit, 1, "Add file2")]
+            }),
+            "refs": {"nodes": [
+                {"name": "backport/1-to-release/1.1", "associatedPullRequests": {"nodes": [{"url": "https://github.com/Cray-HPE/test/pull/3"}]}},
+                {"name": "old/backport/1-to-release/1.0", "associatedPullRequests": {"nodes": []}}
+            ]}
+        }}})
+        stub.add("POST", "/graphql", 200, {"data": {"repository": {
+            "pullRequest": dict(pull_request, commits={
+                "pageInfo": {"hasNextPage": False, "endCursor": "cursor2"},
+                "nodes": [commit_node(merge_commit, 2, "Merge branch feature")]
+            })
+        }}})
+        stub.add("POST", "/repos/Cray-HPE/test/issues/1/comments", 201, {"id": 1})
+        event_data = {
+            "issue": {
+                "number": 1
+            },
+            "comment": {
+                "body": "/backport --dry-run release/1.0 release/1.1"
+            },
+            "repository": {
+                "clone_url": "https://github.com/Cray-HPE/test.git"
+            }
+        }
+        cmd = backport_command.cmd
+        with patch("backport_command.cmd", side_effect=cmd) as cmd_spy:
+            result = backport_command.main(event_data)
+        self.assertEqual(result, 1)
+        get_remote_backport_branches.assert_not_called()
+        # PR data and commits are fetched by single paginated query, and commit metadata is not looked up locally
+        self.assertEqual(list(map(lambda x: (x[0], x[1]), stub.requests))[:2], [("POST", "/graphql"), ("POST", "/graphql")])
+        self.assertEqual(json.loads(stub.requests[0][4])["variables"]["branchQuery"], "backport/1-to-")
+        self.assertEqual(json.loads(stub.requests[1][4])["variables"]["cursor"], "cursor1")
+        self.assertEqual(len(list(filter(lambda x: x[1] == "/graphql", stub.requests))), 2)
+        self.assertFalse(any(map(lambda x: "%H%x00%P" in x.args[0], cmd_spy.call_args_list)))
+        self.assertEqual(backport_command.graphql_pr_data, {})
+        comments = "".join(map(lambda x: json.loads(x[4])["body"], filter(lambda x: x[1].endswith("/comments"), stub.requests)))
+        self.assertIn("Open backport PR: https://github.com/Cray-HPE/test/pull/3", comments)
+        self.assertIn("Dry run backporting into branch release/1.0 was successful.", comments)
+        self.assertEqual(backport_command.cmd("git log -1 --format='%an' backport/1-to-release/1.0")[0], os.environ["GIT_AUTHOR_NAME"])
+        self.assertEqual(backport_command.cmd("git show --format='' --name-only backport/1-to-release/1.0")[0], "file2")
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def testHttpCache(self):
+        tempdir = tempfile.mkdtemp()
+        stub = self.startStubApi({"BACKPORT_HTTP_CACHE_DIR": tempdir})
+        commits_path = "/repos/Cray-HPE/test/pulls/1/commits?per_page=100"
+        stub.add("GET", commits_path, 200, [{"sha": "a"}],
+            {"ETag": "\"page1\"", "Link": "<%s%s&page=2>; rel=\"next\"" % (stub.url, commits_path)})
+        stub.add("GET", commits_path, 304, None, {"ETag": "\"page1\""})
+        stub.add("GET", commits_path + "&page=2", 200, [{"sha": "b"}], {"Last-Modified": "Tue, 02 Nov 2021 10:00:00 GMT"})
+        stub.add("GET", commits_path + "&page=2", 304, None)
+        hits = backport_command.http_cache_stats["hits"]
+        self.assertEqual(list(backport_command.get_pr_commits(1)), ["a", "b"])
+        # Second run revalidates cached pages, and still follows Link header of cached first page
+        self.assertEqual(list(backport_command.get_pr_commits(1)), ["a", "b"])
+        self.assertEqual(backport_command.http_cache_stats["hits"] - hits, 2)
+        self.assertEqual(list(map(lambda x: x[3].get("If-None-Match"), stub.requests)), [None, None, "\"page1\"", None])
+        self.assertEqual(stub.requests[3][3].get("If-Modified-Since"), "Tue, 02 Nov 2021 10:00:00 GMT")
+        # Least recently used response is evicted first
+        first_page = backport_command.get_http_cache_path(stub.url + commits_path)
+        os.utime(first_page, (0, 0))
+        backport_command.prune_http_cache(tempdir, os.path.getsize(first_page) + 1)
+        self.assertEqual(len(os.listdir(tempdir)), 1)
+        self.assertFalse(os.path.exists(first_page))
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    @patch("backport_command.API_WRITE_INTERVAL", 0)
+    def testBatchBackport(self):
+        tempdir = tempfile.mkdtemp()
+        stub = self.startStubApi({"BACKPORT_PARALLEL": "2"})
+        url = self.createOriginRepo(tempdir)
+        # PR #1 had already been backported into main, PR #3 is closed without merging
+        work = os.path.join(tempdir, "work")
+        os.chdir(work)
+        backport_command.cmd("git checkout -q -b feature2 main")
+        backport_command.cmd("echo 'Other content for file2' > file2 && git add file2 && git commit -q -m 'Add other file2'")
+        backport_command.cmd("git push -q %s feature2:refs/pull/2/head" % url)
+        backport_command.cmd("git push -q %s feature:backport/1-to-main" % url)
+        os.chdir(tempdir)
+        stub.add("GET", "/repos/Cray-HPE/test/issues?state=closed&labels=needs%20backport&per_page=100", 200, [
+            {"number": 2, "pull_request": {"merged_at": "2021-11-02T10:00:00Z"}},
+            {"number": 3, "pull_request": {"merged_at": None}},
+            {"number": 4}
+        ])
+        for pr_number in [1, 2]:
+            stub.add("GET", "/repos/Cray-HPE/test/pulls/%d" % pr_number, 200, {
+                "number": pr_number,
+                "title": "Test PR #%d" % pr_number,
+                "_links": {
+                    "html": {
+                        "href": "https://github.com/Cray-HPE/test/pull/%d" % pr_number
+                    }
+                }
+            })
+            stub.add("GET", "/repos/Cray-HPE/test/pulls/%d/commits?per_page=100" % pr_number, 200,
+                [{"sha": backport_command.cmd("git -C %s rev-parse refs/pull/%d/head" % (url[len("file://"):], pr_number))[0]}])
+        stub.add("POST", "/repos/Cray-HPE/test/pulls", 201, {"number": 5, "html_url": "https://github.com/Cray-HPE/test/pull/5"})
+        stub.add("POST", "/repos/Cray-HPE/test/issues/1/comments", 201, {"id": 1})
+        stub.add("POST", "/repos/Cray-HPE/test/issues/2/comments", 201, {"id": 2})
+        summary = os.path.join(tempdir, "summary.json")
+        result = backport_command.batch_main(["--prs", "1", "--label", "needs backport", "--branches", "release/1.0,main",
+            "--summary", summary, "--url", url])
+        self.assertEqual(result, 1)
+        with open(summary) as f:
+            data = json.load(f)
+        self.assertEqual(data["prs"], [1, 2])
+        self.assertEqual(list(map(lambda x: (x["pr"], x["branch"], x["status"]), data["results"])), [
+            (1, "release/1.0", "success"), (1, "main", "failed"), (2, "release/1.0", "success"), (2, "main", "success")])
+        self.assertIn("already exists", data["results"][1]["message"])
+        self.assertIn("https://github.com/Cray-HPE/test/pull/5", data["results"][2]["message"])
+        # Heads of all PRs are fetched into single clone
+        with open(os.path.join(tempdir, "test", ".git", "FETCH_HEAD")) as f:
+            self.assertEqual(re.findall("'(refs/pull/[0-9]+/head)'", f.read()), ["refs/pull/1/head", "refs/pull/2/head"])
+        origin = url[len("file://"):]
+        self.assertEqual(backport_command.cmd("git -C %s log --format='%%s' backport/2-to-release/1.0" % origin)[0].split("\n"),
+            ["Add other file2", "Add file1"])
+        self.assertEqual(len(list(filter(lambda x: x[0] == "POST" and x[1] == "/repos/Cray-HPE/test/pulls", stub.requests))), 3)
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def testBatchCloneFailure(self):
+        tempdir = tempfile.mkdtemp()
+        stub = self.startStubApi({"BACKPORT_BATCH_SUMMARY": ""})
+        url = self.createOriginRepo(tempdir)
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 200, {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/test/pull/1"
+                }
+            }
+        })
+        # Fetch of missing branch fails after changing into clone directory
+        result = backport_command.batch_main(["--prs", "1", "--branches", "release/1.0 release/9.9", "--url", url])
+        self.assertEqual(result, 2)
+        with open(os.path.join(tempdir, "backport-summary.json")) as f:
+            data = json.load(f)
+        self.assertEqual(list(map(lambda x: (x["pr"], x["branch"], x["status"]), data["results"])), [
+            (1, "release/1.0", "failed"), (1, "release/9.9", "failed")])
+        self.assertIn("Error occured while cloning repo", data["results"][0]["message"])
+        self.assertEqual(list(filter(lambda x: x[0] != "GET", stub.requests)), [])
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def testWebhookServer(self):
+        tempdir = tempfile.mkdtemp()
+        stub = self.startStubApi()
+        origin = self.createOriginRepo(tempdir)[len("file://"):]
+        # Repositories are served from directory pretending to be GitHub
+        github_url = "file://%s/github" % tempdir
+        url = "%s/Cray-HPE/test.git" % github_url
+        os.makedirs(os.path.join(tempdir, "github", "Cray-HPE"))
+        os.symlink(origin, os.path.join(tempdir, "github", "Cray-HPE", "test.git"))
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 200, {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/test/pull/1"
+                }
+            }
+        })
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1/commits?per_page=100", 200,
+            [{"sha": backport_command.cmd("git -C %s rev-parse refs/pull/1/head" % origin)[0]}])
+        stub.add("POST", "/repos/Cray-HPE/test/pulls", 201, {"number": 2, "html_url": "https://github.com/Cray-HPE/test/pull/2"})
+        stub.add("POST", "/repos/Cray-HPE/test/issues/1/comments", 201, {"id": 1})
+        config = {
+            "api_url": stub.url,
+            "token": "token",
+            "cache_dir": os.path.join(tempdir, "cache"),
+            "workdir": tempdir,
+            "log_level": logging.WARNING
+        }
+        queue = backport_server.JobQueue(2, functools.partial(backport_server.run_job_process, config))
+        server = backport_server.create_server(("127.0.0.1", 0), queue, "secret", github_url)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        server_url = "http://127.0.0.1:%d" % server.server_address[1]
+        def send(event_name, event, secret = "secret"):
+            body = json.dumps(event).encode()
+            return requests.post(server_url + "/webhook", data=body, headers={
+                "X-GitHub-Event": event_name,
+                "X-Hub-Signature-256": "sha256=%s" % hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+            })
+        event_data = {
+            "action": "created",
+            "issue": {
+                "number": 1,
+                "pull_request": {}
+            },
+            "comment": {
+                "body": "/backport release/1.0"
+            },
+            "repository": {
+                "full_name": "Cray-HPE/test",
+                "clone_url": url
+            }
+        }
+        self.assertEqual(send("issue_comment", event_data, "wrong").status_code, 401)
+        with patch("backport_server.WEBHOOK_MAX_SIZE", 100):
+            self.assertEqual(send("issue_comment", event_data).status_code, 413)
+        self.assertEqual(send("issue_comment", dict(event_data, issue={"number": 1})).json(), {"ignored": "comment on issue"})
+        # Server token is never sent to other hosts, repository name can't escape cache directory
+        for repository in [{"full_name": "Cray-HPE/test", "clone_url": "https://example.com/Cray-HPE/test.git"},
+                {"full_name": "Cray-HPE/other", "clone_url": url},
+                {"full_name": "../..", "clone_url": "%s/../...git" % github_url},
+                {"full_name": "Cray-HPE/test/../../x", "clone_url": "%s/Cray-HPE/test/../../x.git" % github_url}]:
+            self.assertEqual(send("issue_comment", dict(event_data, repository=repository)).status_code, 400)
+        self.assertRaises(ValueError, backport_server.create_server, ("127.0.0.1", 0), queue, None, github_url)
+        response = send("issue_comment", event_data)
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(queue.wait_idle(60))
+        metrics = requests.get(server_url + "/metrics").text
+        self.assertIn("backport_queue_depth 0\n", metrics)
+        self.assertIn("backport_jobs_total{result=\"success\"} 1\n", metrics)
+        self.assertIn("backport_job_duration_seconds_count 1\n", metrics)
+        server.shutdown()
+        server.server_close()
+        queue.stop()
+        # Job ran with warm mirror in cache directory and left no working copy behind
+        self.assertEqual(backport_command.cmd("git -C %s log --format='%%s' backport/1-to-release/1.0" % origin)[0].split("\n"),
+            ["Add file2", "Add file1"])
+        self.assertTrue(os.path.isdir(os.path.join(tempdir, "cache", "Cray-HPE", "test.git")))
+        self.assertEqual(list(filter(lambda x: x.startswith("backport-job-"), os.listdir(tempdir))), [])
+        self.assertEqual(len(list(filter(lambda x: x[0] == "POST" and x[1] == "/repos/Cray-HPE/test/pulls", stub.requests))), 1)
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def testJobQueue(self):
+        runs = []
+        def runner(job):
+            start = time.monotonic()
+            time.sleep(0.2)
+            runs.append((job["event"]["comment"]["body"], start, time.monotonic()))
+            return 0 if job["repository"] == "repo1" else 1
+        queue = backport_server.JobQueue(2, runner)
+        for repository, body in [("repo1", "a1"), ("repo1", "a2"), ("repo2", "b")]:
+            queue.submit(repository, {"issue": {"number": 1}, "comment": {"body": body}})
+        self.assertTrue(queue.wait_idle(10))
+        queue.stop()
+        runs = dict(map(lambda x: (x[0], x[1:]), runs))
+        # Jobs of one repository run one after another, other repositories are not blocked by them
+        self.assertGreaterEqual(runs["a2"][0], runs["a1"][1])
+        self.assertLess(runs["b"][0], runs["a1"][1])
+        metrics = queue.render_metrics()
+        self.assertIn("backport_jobs_total{result=\"success\"} 2\n", metrics)
+        self.assertIn("backport_jobs_total{result=\"failure\"} 1\n", metrics)
+
+    @patch.dict(os.environ, {"BACKPORT_SPARSE_CHECKOUT": "true", "GITHUB_REPOSITORY": "Cray-HPE/test"})
+    @patch("backport_command.post_comment")
+    @patch("backport_command.create_pr")
+    @patch("backport_command.get_pr_commits")
+    def testSparseCheckout(self, get_pr_commits, create_pr, post_comment):
+        tempdir = tempfile.mkdtemp()
+        origin = os.path.join(tempdir, "origin.git")
+        backport_command.cmd("git init -q --bare --initial-branch=main %s" % origin)
+        os.chdir(tempdir)
+        backport_command.cmd("git init -q --initial-branch=main work")
+        os.chdir("work")
+        backport_command.cmd("mkdir -p a b d/e && touch top b/f d/e/f && seq 1 20 > a/f && git add . && git commit -q -m 'Add files'")
+        backport_command.cmd("git branch release/1.0")
+        backport_command.cmd("git checkout -q -b release/1.1")
+        backport_command.cmd("git mv a/f b/f2 && sed -i 's/^5$/five/' b/f2 && git commit -q -a -m 'Move a/f to b'")
+        backport_command.cmd("git checkout -q -b feature main")
+        backport_command.cmd("echo change > a/f && mkdir -p c/g && touch c/g/new && git add . && git commit -q -m 'Change a, add c'")
+        backport_command.cmd("git push -q %s main release/1.0 release/1.1 feature:refs/pull/1/head" % origin)
+        os.chdir(tempdir)
+        url = "file://%s" % origin
+        auth_header = backport_command.get_auth_header(url)
+        backport_command.clone(url, ["release/1.0", "release/1.1"], [1], auth_header)
+        post_comment.assert_not_called()
+        self.assertEqual(sorted(os.listdir(".")), [".git", "top"])
+        get_pr_commits.return_value = [backport_command.cmd("git rev-parse FETCH_HEAD")[0]]
+        pr_data = {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/backport-command-action/pull/1"
+                }
+            }
+        }
+        result = backport_command.backport("release/1.0", pr_data, False, auth_header)
+        self.assertEqual(result, 0)
+        # Only directories changed by PR are checked out, pushed branch has complete tree
+        self.assertEqual(backport_command.cmd("git sparse-checkout list")[0].split("\n"), ["a", "c/g"])
+        self.assertEqual(backport_command.cmd("find . -path ./.git -prune -o -type f -print | sort")[0].split("\n"),
+            ["./a/f", "./c/g/new", "./top"])
+        self.assertEqual(backport_command.cmd("git -C %s ls-tree -r --name-only backport/1-to-release/1.0" % origin)[0].split("\n"),
+            ["a/f", "b/f", "c/g/new", "d/e/f", "top"])
+        # Conflict outside of sparse checkout is checked out by git and reported as usual, sparse checkout is kept
+        post_comment.reset_mock()
+        backport_command.cmd("git checkout -q --detach origin/release/1.1")
+        result = backport_command.backport("release/1.1", pr_data, False, auth_header)
+        self.assertEqual(result, 1)
+        post_comment.assert_called_once_with(1, self.AnyStringWith("CONFLICT (content): Merge conflict in b/f2"))
+        self.assertTrue(os.path.isfile("b/f2"))
+        self.assertEqual(backport_command.cmd("git sparse-checkout list")[0].split("\n"), ["a", "c/g"])
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def testRunMetrics(self):
+        tempdir = tempfile.mkdtemp()
+        metrics_file = os.path.join(tempdir, "metrics.json")
+        summary_file = os.path.join(tempdir, "summary.md")
+        stub = self.startStubApi({"BACKPORT_METRICS_FILE": metrics_file, "GITHUB_STEP_SUMMARY": summary_file})
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git branch release/1.0")
+        self.addFile("file2")
+        backport_command.cmd("git remote add origin ./.git")
+        backport_command.cmd("git fetch --all")
+        commit_hash = backport_command.cmd("git log -1 --format='%H'")[0]
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1/commits?per_page=100", 200, [{"sha": commit_hash}])
+        stub.add("POST", "/repos/Cray-HPE/test/pulls", 201, {"number": 2, "html_url": "https://github.com/Cray-HPE/test/pull/2"})
+        stub.add("POST", "/repos/Cray-HPE/test/issues/1/comments", 201, {"id": 1})
+        pr_data = {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/test/pull/1"
+                }
+            }
+        }
+        with patch("backport_command.run_metrics", backport_command.RunMetrics()):
+            result = backport_command.backport("release/1.0", pr_data, False, backport_command.get_auth_header("https://github.com"))
+            self.assertEqual(result, 0)
+            backport_command.run_metrics.ran = True
+            backport_command.write_metrics(metrics_file)
+        with open(metrics_file) as f:
+            data = json.load(f)
+        self.assertEqual(data["counters"]["api_requests"], 3)
+        self.assertGreater(data["counters"]["subprocesses"], 5)
+        self.assertLessEqual({"api", "cherry-pick", "push", "backport"}, set(data["summary"].keys()))
+        self.assertEqual(data["summary"]["api"]["count"], 3)
+        cherry_pick = next(filter(lambda x: x["phase"] == "cherry-pick", data["phases"]))
+        self.assertEqual(cherry_pick["detail"], "%s into release/1.0" % commit_hash)
+        self.assertEqual(cherry_pick["seconds"], data["summary"]["cherry-pick"]["total_seconds"])
+        # Cherry-pick runs within backport phase
+        backport = next(filter(lambda x: x["phase"] == "backport", data["phases"]))
+        self.assertGreaterEqual(cherry_pick["start_seconds"], backport["start_seconds"])
+        self.assertLessEqual(cherry_pick["start_seconds"] + cherry_pick["seconds"], backport["start_seconds"] + backport["seconds"] + 0.001)
+        with open(summary_file) as f:
+            summary = f.read()
+        self.assertIn("| cherry-pick | 1 |", summary)
+        self.assertIn("subprocesses, 3 API requests.", summary)
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def testRunMetricsFile(self):
+        tempdir = tempfile.mkdtemp()
+        stub = self.startStubApi()
+        url = self.createOriginRepo(tempdir)
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1", 200, {
+            "number": 1,
+            "title": "Test PR #1",
+            "_links": {
+                "html": {
+                    "href": "https://github.com/Cray-HPE/test/pull/1"
+                }
+            }
+        })
+        stub.add("GET", "/repos/Cray-HPE/test/pulls/1/commits?per_page=100", 200,
+            [{"sha": backport_command.cmd("git -C %s/origin.git rev-parse refs/pull/1/head" % tempdir)[0]}])
+        stub.add("POST", "/repos/Cray-HPE/test/issues/1/comments", 201, {"id": 1})
+        def run(comment, metrics_file):
+            # Runs the script the way the action does, with metrics file relative to its working directory
+            with open(os.path.join(tempdir, "event.json"), "w") as f:
+                json.dump({"issue": {"number": 1}, "comment": {"body": comment}, "repository": {"clone_url": url}}, f)
+            env = dict(os.environ, GITHUB_EVENT_PATH=os.path.join(tempdir, "event.json"), BACKPORT_METRICS_FILE=metrics_file,
+                GITHUB_STEP_SUMMARY=os.path.join(tempdir, "summary.md"))
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backport_command.py")
+            return subprocess.run([sys.executable, script], cwd=tempdir, env=env, capture_output=True).returncode
+        self.assertEqual(run("/backport --dry-run release/1.0", "metrics.json"), 0)
+        with open(os.path.join(tempdir, "metrics.json")) as f:
+            self.assertIn("clone", json.load(f)["summary"])
+        with open(os.path.join(tempdir, "summary.md")) as f:
+            summary = f.read()
+        # Comments other than /backport leave no metrics
+        self.assertEqual(run("Looks good", "other.json"), 0)
+        self.assertFalse(os.path.exists(os.path.join(tempdir, "other.json")))
+        with open(os.path.join(tempdir, "summary.md")) as f:
+            self.assertEqual(f.read(), summary)
+        backport_command.cmd("rm -rf %s" % tempdir)
+
+    def testApiLimiter(self):
+        calls = []
+        def http_call(url, method, data):
+            calls.append((url, time.monotonic()))
+            time.sleep(0.1)
+        async def run():
+            limiter = backport_command.ApiLimiter(2, 0.2)
+            await asyncio.gather(limiter.call("get", "GET"), *(limiter.call("post%d" % i, "POST") for i in range(3)))
+        # Writes run concurrently until GitHub rate limits a request
+        with patch("backport_command.http_call", side_effect=http_call):
+            asyncio.run(run())
+        self.assertEqual(list(map(lambda x: x[0], calls)), ["get", "post0", "post1", "post2"])
+        self.assertLess(calls[3][1] - calls[0][1], 0.15)
+        calls.clear()
+        with patch("backport_command.http_call", side_effect=http_call), patch("backport_command.rate_limit_hit") as rate_limit_hit:
+            rate_limit_hit.is_set.return_value = True
+            asyncio.run(run())
+        self.assertEqual(list(map(lambda x: x[0], calls)), ["get", "post0", "post1", "post2"])
+        # Reads are not delayed, writes are spaced by write interval
+        self.assertLess(calls[1][1] - calls[0][1], 0.1)
+        self.assertGreater(calls[2][1] - calls[1][1], 0.15)
+        self.assertGreater(calls[3][1] - calls[2][1], 0.15)
+
+    def testCommitsInfo(self):
+        tempdir = tempfile.mkdtemp()
+        os.chdir(tempdir)
+        backport_command.cmd("git init --initial-branch=main")
+        self.addFile("file1")
+        backport_command.cmd("git checkout -b feature")
+        self.addFile("file2")
+        backport_command.cmd("git checkout main")
+        self.addFile("file3")
+        backport_command.cmd("git merge --no-ff feature")
+        commits = backport_command.cmd("git log --format='%H' --topo-order")[0].split("\n")
+        result = backport_command.get_commits_info(commits)
+        self.assertEqual([info["parents"] for info in result], [2, 1, 1, 0])
+        self.assertEqual([info["sha"] for info in result], commits)
+        self.assertEqual(result[1]["author_name"], os.environ["GIT_AUTHOR_NAME"])
+        self.assertEqual(result[1]["author_email"], os.environ["GIT_AUTHOR_EMAIL"])
+        # Repeated lookup should be served from cache
+        with patch("backport_command.cmd") as cmd:
+            self.assertTrue(backport_command.is_merge_commit(commits[0]))
+            self.assertFalse(backport_command.is_merge_commit(commits[1]))
+            cmd.assert_not_called()
+        backport_command.cmd("rm -rf %s" % tempdir)
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.CRITICAL)
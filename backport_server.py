@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+#
+# MIT License
+#
+# (C) Copyright [2021] Hewlett Packard Enterprise Development LP
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+import argparse
+import collections
+import functools
+import hashlib
+import hmac
+import http.server
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import backport_command
+
+# Default number of backport jobs running at once
+SERVER_CONCURRENCY = 4
+# Default directory of warm repository mirrors, shared by all jobs
+SERVER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "backport-command")
+# Largest accepted webhook payload, GitHub caps payloads at 25 MB
+WEBHOOK_MAX_SIZE = 25 * 1024 * 1024
+
+# Jobs are run in processes forked from a single-threaded server process, which has backport_command
+# already imported. Every job gets its own environment, working directory and module state.
+process_context = multiprocessing.get_context("forkserver")
+process_context.set_forkserver_preload(["backport_command"])
+
+def run_job(config, job):
+    # Entry point of job process. Exit code is the return code of backport_command.main().
+    logging.basicConfig(format="[job %d %s#%d] %%(message)s" % (job["id"], job["repository"], job["event"]["issue"]["number"]),
+        level=config["log_level"], force=True)
+    os.environ["GITHUB_REPOSITORY"] = job["repository"]
+    os.environ["GITHUB_API_URL"] = config["api_url"]
+    os.environ["GITHUB_TOKEN"] = config["token"]
+    os.environ["BACKPORT_CACHE_DIR"] = config["cache_dir"]
+    workdir = tempfile.mkdtemp(prefix="backport-job-", dir=config["workdir"])
+    os.chdir(workdir)
+    try:
+        return_code = backport_command.main(job["event"])
+    except Exception:
+        logging.exception("::error::Job failed")
+        return_code = 1
+    finally:
+        os.chdir("/")
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(min(return_code, 255))
+
+def run_job_process(config, job):
+    process = process_context.Process(target=run_job, args=(config, job))
+    process.start()
+    process.join()
+    return process.exitcode
+
+class JobQueue:
+    """Queue of backport jobs executed by pool of worker threads. Jobs of one repository run one after
+    another in the order they were received, so that they don't compete for its mirror, jobs of
+    different repositories run concurrently up to the concurrency limit."""
+
+    def __init__(self, concurrency, runner):
+        self.runner = runner
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+        self.busy = set()
+        self.stopped = False
+        self.ids = itertools.count(1)
+        self.metrics = {
+            "running": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "wait_seconds": 0.0,
+            "duration_seconds": 0.0
+        }
+        self.workers = [threading.Thread(target=self.work, daemon=True) for i in range(concurrency)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, repository, event):
+        with self.condition:
+            job = {"id": next(self.ids), "repository": repository, "event": event, "received": time.monotonic()}
+            self.pending.append(job)
+            self.condition.notify_all()
+            return job["id"]
+
+    def take(self):
+        # Waits for the oldest job of repository which has no job running. Returns None once queue is stopped.
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+                job = next(filter(lambda x: x["repository"] not in self.busy, self.pending), None)
+                if job is not None:
+                    self.pending.remove(job)
+                    self.busy.add(job["repository"])
+                    self.metrics["running"] += 1
+                    self.metrics["wait_seconds"] += time.monotonic() - job["received"]
+                    return job
+                self.condition.wait()
+
+    def work(self):
+        while True:
+            job = self.take()
+            if job is None:
+                return
+            start = time.monotonic()
+            try:
+                logging.info("Starting job %d: %s PR #%d" % (job["id"], job["repository"], job["event"]["issue"]["number"]))
+                return_code = self.runner(job)
+            except Exception:
+                logging.exception("Error occurred while running job %d" % job["id"])
+                return_code = 1
+            logging.info("Finished job %d with return code %d in %.1fs" % (job["id"], return_code, time.monotonic() - start))
+            with self.condition:
+                self.busy.remove(job["repository"])
+                self.metrics["running"] -= 1
+                self.metrics["succeeded" if return_code == 0 else "failed"] += 1
+                self.metrics["duration_seconds"] += time.monotonic() - start
+                self.condition.notify_all()
+
+    def wait_idle(self, timeout = None):
+        # Waits until there are no pending nor running jobs. Returns False on timeout.
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.pending) == 0 and self.metrics["running"] == 0, timeout)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def render_metrics(self):
+        # Metrics in Prometheus text format
+        with self.condition:
+            metrics = dict(self.metrics, depth=len(self.pending))
+        completed = metrics["succeeded"] + metrics["failed"]
+        return "\n".join([
+            "# HELP backport_queue_depth Number of jobs waiting in queue.",
+            "# TYPE backport_queue_depth gauge",
+            "backport_queue_depth %d" % metrics["depth"],
+            "# HELP backport_jobs_running Number of jobs running.",
+            "# TYPE backport_jobs_running gauge",
+            "backport_jobs_running %d" % metrics["running"],
+            "# HELP backport_jobs_total Number of finished jobs.",
+            "# TYPE backport_jobs_total counter",
+            "backport_jobs_total{result=\"success\"} %d" % metrics["succeeded"],
+            "backport_jobs_total{result=\"failure\"} %d" % metrics["failed"],
+            "# HELP backport_job_wait_seconds Time jobs spent in queue.",
+            "# TYPE backport_job_wait_seconds summary",
+            "backport_job_wait_seconds_sum %.3f" % metrics["wait_seconds"],
+            "backport_job_wait_seconds_count %d" % (completed + metrics["running"]),
+            "# HELP backport_job_duration_seconds Time jobs spent running.",
+            "# TYPE backport_job_duration_seconds summary",
+            "backport_job_duration_seconds_sum %.3f" % metrics["duration_seconds"],
+            "backport_job_duration_seconds_count %d" % completed
+        ]) + "\n"
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """Accepts issue_comment webhooks of GitHub at any path and queues backport jobs for /backport comments,
+    serves queue metrics at /metrics."""
+
+    protocol_version = "HTTP/1.1"
+
+    def send(self, status, content, content_type = "application/json"):
+        content = content.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send(200, self.server.queue.render_metrics(), "text/plain; version=0.0.4")
+        elif self.path == "/healthz":
+            self.send(200, json.dumps({"status": "ok"}))
+        else:
+            self.send(404, json.dumps({"message": "Not Found"}))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > WEBHOOK_MAX_SIZE:
+            # Body is not read before the signature can be checked, so the connection can't be reused
+            self.close_connection = True
+            self.send(413, json.dumps({"message": "Payload too large"}))
+            return
+        body = self.rfile.read(length)
+        signature = "sha256=%s" % hmac.new(self.server.secret.encode(), body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature, self.headers.get("X-Hub-Signature-256", "")):
+            self.send(401, json.dumps({"message": "Invalid signature"}))
+            return
+        try:
+            event = json.loads(body)
+        except ValueError:
+            self.send(400, json.dumps({"message": "Invalid JSON payload"}))
+            return
+        reason = get_ignore_reason(self.headers.get("X-GitHub-Event"), event)
+        if reason is not None:
+            self.send(200, json.dumps({"ignored": reason}))
+            return
+        # Jobs send server token to the clone URL and use repository name in mirror path
+        error = get_repository_error(event["repository"], self.server.github_url)
+        if error is not None:
+            self.send(400, json.dumps({"message": error}))
+            return
+        job_id = self.server.queue.submit(event["repository"]["full_name"], event)
+        logging.info("Queued job %d: %s PR #%d" % (job_id, event["repository"]["full_name"], event["issue"]["number"]))
+        self.send(202, json.dumps({"job": job_id}))
+
+    def log_message(self, format, *args):
+        logging.debug("::debug::%s %s" % (self.address_string(), format % args))
+
+def get_ignore_reason(event_name, event):
+    # Returns reason why webhook does not lead to backport job, None if it does
+    if event_name != "issue_comment":
+        return "event %s" % event_name
+    if event.get("action") != "created":
+        return "action %s" % event.get("action")
+    if "pull_request" not in event.get("issue", {}):
+        return "comment on issue"
+    if not event.get("comment", {}).get("body", "").startswith("/backport"):
+        return "not a /backport command"
+    return None
+
+def get_repository_error(repository, github_url):
+    # Returns reason why repository of webhook is not accepted, None if it is
+    full_name = repository.get("full_name")
+    if not isinstance(full_name, str) or not re.match(r"^[\w.-]+/[\w.-]+$", full_name) or \
+            any(map(lambda x: x.strip(".") == "", full_name.split("/"))):
+        return "Invalid repository name %s" % full_name
+    if repository.get("clone_url") != "%s/%s.git" % (github_url, full_name):
+        return "Clone URL %s of repository %s is not on %s" % (repository.get("clone_url"), full_name, github_url)
+    return None
+
+def create_server(address, queue, secret, github_url):
+    if not secret:
+        raise ValueError("Webhook secret is required")
+    server = http.server.ThreadingHTTPServer(address, WebhookHandler)
+    server.queue = queue
+    server.secret = secret
+    server.github_url = github_url.rstrip("/")
+    return server
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Serve GitHub issue_comment webhooks, backporting PRs on /backport comments")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--concurrency", type=int, default=SERVER_CONCURRENCY, help="number of jobs running at once")
+    parser.add_argument("--cache-dir", default=os.environ.get("BACKPORT_CACHE_DIR") or SERVER_CACHE_DIR,
+        help="directory of warm repository mirrors")
+    parser.add_argument("--workdir", default=tempfile.gettempdir(), help="directory of job working copies")
+    parser.add_argument("--api-url", default=os.environ.get("GITHUB_API_URL") or "https://api.github.com",
+        help="URL of GitHub API")
+    parser.add_argument("--github-url", default=os.environ.get("GITHUB_SERVER_URL") or "https://github.com",
+        help="URL of GitHub, repositories of webhooks must be cloned from it")
+    options = parser.parse_args(args)
+    if not os.environ.get("GITHUB_TOKEN"):
+        parser.error("GITHUB_TOKEN environment variable is not set")
+    if not os.environ.get("BACKPORT_WEBHOOK_SECRET"):
+        parser.error("BACKPORT_WEBHOOK_SECRET environment variable is not set")
+    config = {
+        "api_url": options.api_url,
+        "token": os.environ["GITHUB_TOKEN"],
+        "cache_dir": os.path.abspath(options.cache_dir),
+        "workdir": options.workdir,
+        "log_level": logging.getLogger().level
+    }
+    queue = JobQueue(options.concurrency, functools.partial(run_job_process, config))
+    server = create_server((options.host, options.port), queue, os.environ["BACKPORT_WEBHOOK_SECRET"], options.github_url)
+    logging.info("Listening on %s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info("Waiting for running jobs to finish")
+        queue.stop()
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s", level=logging.DEBUG if os.environ.get("RUNNER_DEBUG") == "1" else logging.INFO)
+    sys.exit(main(sys.argv[1:]))
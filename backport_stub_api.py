@@ -0,0 +1,70 @@
+#
+# MIT License
+#
+# (C) Copyright 2023 Hewlett Packard Enterprise Development LP
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+import http.server
+import json
+import threading
+
+class StubGitHubApi:
+    """Local HTTP server pretending to be GitHub API. Responses are queued per (method, path),
+    the last queued response for a path is served for all subsequent requests."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def handle_request(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length).decode() if length > 0 else None
+            self.server.stub.requests.append((self.command, self.path, self.client_address, dict(self.headers), body))
+            responses = self.server.stub.responses.get((self.command, self.path), [(404, {}, {"message": "Not Found"})])
+            status, headers, data = responses.pop(0) if len(responses) > 1 else responses[0]
+            content = json.dumps(data).encode() if status != 304 else b""
+            self.send_response(status)
+            for header in headers:
+                self.send_header(header, headers[header])
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = handle_request
+        do_POST = handle_request
+        do_PATCH = handle_request
+
+        def log_message(self, format, *args):
+            pass
+
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.Handler)
+        self.server.stub = self
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add(self, method, path, status, data, headers = {}):
+        self.responses.setdefault((method, path), []).append((status, headers, data))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()